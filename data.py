@@ -1,231 +1,548 @@
+import os
 import sys
 import copy
+import pickle
+import shutil
+import hashlib
+import inspect
+import tempfile
+import functools
 import torch
 import random
 import numpy as np
 from collections import defaultdict
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, shared_memory
 import pdb
 import math
 from scipy.stats import rankdata, percentileofscore
 
 
+class UserHistories(object):
+    """
+    one field (item, time4, time6 or time embedding) of every user's history as a flat int array
+    user u owns values[offsets[u]:offsets[u + 1]] minus the last stop values, which are held out for valid/test
+    indexing by user gives the last width values left-padded with zeros, window gives the same for a batch of users
+    with width None rows are returned unpadded and batches are padded to their longest row
+    users before first have no history, which is the case for all but one shard of a UserShards dataset
+    """
+
+    def __init__(self, values, offsets, width=None, stop=0):
+        self.values = values
+        self.offsets = offsets
+        self.width = width
+        self.stop = stop
+        self.first = max(1, int(np.argmax(np.diff(offsets) > 0))) if len(offsets) > 1 else 1
+
+    def __len__(self):
+        return len(self.offsets) - 2
+
+    def bounds(self, users):
+        starts = self.offsets[users]
+        return starts, np.maximum(starts, self.offsets[users + 1] - self.stop)
+
+    def lengths(self, users=None):
+        if users is None:
+            users = np.arange(len(self.offsets) - 1)
+        starts, ends = self.bounds(users)
+        return ends - starts
+
+    def flat(self):
+        """
+        user id and value of every position of every user's history, in user order
+        """
+        lens = self.lengths()
+        owner = np.repeat(np.arange(len(lens)), lens)
+        starts = np.cumsum(lens) - lens
+        return owner, self.values[self.offsets[owner] + np.arange(len(owner)) - starts[owner]]
+
+    def __getitem__(self, user):
+        start, end = self.bounds(user)
+        if self.width is None:
+            return self.values[start:end]
+        start = max(start, end - self.width)
+        row = np.zeros(self.width, dtype=self.values.dtype)
+        row[self.width - (end - start):] = self.values[start:end]
+        return row
+
+    def window(self, users, width=None):
+        users = np.asarray(users)
+        starts, ends = self.bounds(users)
+        width = self.width if width is None else width
+        if width is None:
+            width = int((ends - starts).max()) if len(users) > 0 else 0
+        positions = ends[:, None] - width + np.arange(width)
+        valid = positions >= starts[:, None]
+        out = np.zeros((len(users), width), dtype=self.values.dtype)
+        out[valid] = self.values[positions[valid]]
+        return out
+
+
+def held_out(values, offsets, back):
+    """
+    value back positions from the end of each user's history, indexed by user id with 0 for users without one
+    """
+    out = np.zeros(len(offsets) - 1, dtype=values.dtype)
+    pos = offsets[2:] - back
+    has = pos >= offsets[1:-1]
+    out[1:][has] = values[pos[has]]
+    return out
+
+
+def time_gap_ranks(times, offsets, maxlen, skip):
+    """
+    relative time embedding of every user as UserHistories of width maxlen
+    gaps between consecutive timestamps among the user's last maxlen + 2, minus the last skip gaps and capped at maxlen,
+    replaced by their argsort + 1, all users at once through one stable sort on (user, gap) so ties keep time order
+    """
+    gaps = np.diff(times)
+    ends = offsets[1:]
+    lo = ends - np.minimum(maxlen + 2, np.diff(offsets))
+    stops = ends - 1 - skip
+    starts = np.maximum(lo, stops - maxlen)
+    lens = np.maximum(0, stops - starts)
+    out_offsets = np.zeros(len(offsets), dtype=np.int64)
+    out_offsets[1:] = np.cumsum(lens)
+    owner = np.repeat(np.arange(len(lens)), lens)
+    pos = starts[owner] + np.arange(out_offsets[-1]) - out_offsets[owner]
+    gaps = gaps[pos]
+    span = int(gaps.max()) + 1 if len(gaps) > 0 else 1
+    if len(lens) < np.iinfo(np.int64).max // span:
+        # (user, gap) packed into one int64 key sorts several times faster than lexsort
+        order = np.argsort(owner * span + gaps, kind="stable")
+    else:
+        order = np.lexsort((gaps, owner))
+    return UserHistories((order - out_offsets[owner] + 1).astype(np.int32), out_offsets, maxlen)
+
+
+def load_interactions(fname, sparse_name='', mod=''):
+    """
+    columnar interaction store written by data/data.py next to the _intwtime csv, memory-mapped
+    user, item, time4, time6, time arrays sorted by user then time, rows of user u are offsets[u]:offsets[u+1]
+    None if there is no store or it is older than the csvs it mirrors
+    """
+    path = f"../data/{fname}_{sparse_name}intwtime{mod}"
+    offsets_path = os.path.join(path, "offsets.npy")
+    if not os.path.exists(offsets_path):
+        return None
+    for csv in [f"{path}.csv", f"../data/{fname}_int2{mod}.csv"]:
+        if os.path.exists(csv) and os.path.getmtime(csv) > os.path.getmtime(offsets_path):
+            return None
+    return {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in ["user", "item", "time4", "time6", "time", "offsets"]}
+
+
+def read_user_histories(fname, sparse_name, mod, csv_path, fields, users=None):
+    """
+    histories of fields (item, time4, time6, time) as flat arrays grouped by user in time order, with usernum and itemnum
+    offsets are indexed by user id + 1 so user u owns values[offsets[u]:offsets[u + 1]]
+    items are shifted by 1 like users, users = (lo, hi) keeps only user ids lo <= u < hi
+    reads the columnar store when present, otherwise parses csv_path line by line
+    """
+    dtypes = {"item": np.int32, "time4": np.int32, "time6": np.int32, "time": np.int64}
+    lo, hi = (1, None) if users is None else users
+    cols = load_interactions(fname, sparse_name, mod)
+    if cols is not None:
+        offsets = cols["offsets"]
+        hi = len(offsets) if hi is None else min(hi, len(offsets))
+        lo = min(lo, hi)
+        start, end = int(offsets[lo - 1]), int(offsets[hi - 1])
+        values = [cols[field][start:end] + 1 if field == "item" else cols[field][start:end] for field in fields]
+        offsets = np.concatenate((np.zeros(lo, dtype=np.int64), offsets[lo - 1:hi] - start))
+    else:
+        index = {"item": 1, "time4": 2, "time6": 3, "time": 4}
+        users = []
+        values = [[] for _ in fields]
+        f = open(csv_path, "r")
+        for line in f:
+            row = line.rstrip().split(",")
+            u = int(row[0]) + 1
+            if u < lo or (hi is not None and u >= hi):
+                continue
+            users.append(u)
+            for k, field in enumerate(fields):
+                if field == "time":
+                    values[k].append(int(float(row[4])))
+                else:
+                    values[k].append(int(row[index[field]]) + (field == "item"))
+        users = np.array(users, dtype=np.int64)
+        order = np.argsort(users, kind="stable")
+        values = [np.array(col, dtype=dtypes[field])[order] for field, col in zip(fields, values)]
+        offsets = np.zeros(users.max() + 2 if len(users) > 0 else 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(users))
+    present = np.nonzero(np.diff(offsets))[0]
+    usernum = int(present[-1]) if len(present) > 0 else 0
+    offsets = offsets[:usernum + 2]
+    itemnum = int(values[0][:offsets[-1]].max()) if usernum > 0 else 0
+    return values, offsets, usernum, itemnum
+
 
-def data_partition_wtime(fname, maxlen, sparse_name = '', override_sparse=False, mod='', std=False):
+
+def data_partition_wtime(fname, maxlen, sparse_name = '', override_sparse=False, mod='', std=False, users=None):
     """
     dataset pre-processing that uses coarse time index, fine time index, and relative time embedding via exact timestamp
     refer to data/data.py for dataset formatting
     """
 
-    usernum = 0
-    itemnum = 0
-    User = [defaultdict(list), defaultdict(list), defaultdict(list), defaultdict(list)]
-    user_dict = {}
-    user_train = ({}, {}, {}, {})
-    user_valid = ({}, {}, {}, {})
-    user_test = ({}, {}, {}, {})
-    f = open(f"../data/{fname}_{sparse_name}intwtime{mod}.csv", "r")
-    for line in f:
-        u, i, t, t2, te = line.rstrip().split(",")
-        u = int(u) + 1
-        i = int(i) + 1
-        t = int(t)
-        t2 = int(t2)
-        te = int(float(te))
-        usernum = max(u, usernum)
-        itemnum = max(i, itemnum)
-        User[0][u].append(i)
-        User[1][u].append(t)
-        User[2][u].append(t2)
-        User[3][u].append(te)
+    (items, time4, time6, times), offsets, usernum, itemnum = read_user_histories(fname, sparse_name, mod, f"../data/{fname}_{sparse_name}intwtime{mod}.csv", ["item", "time4", "time6", "time"], users)
+    lens = np.diff(offsets)
 
     if std:
-        lens = [len(value) for value in User[0].values()]
-        std_dev = np.std(lens)
+        std_dev = np.std(lens[lens > 0])
         print("Std dev", std_dev)
         sys.exit(0)
 
-    for user in User[0]:
-        nfeedback = len(User[0][user])
-        uselen = min(maxlen+2, len(User[3][user]))
-        temp = np.array(User[3][user][-uselen+1:]) - np.array(User[3][user][-uselen:-1])
-        if sparse_name == '' or override_sparse:
-            user_train[0][user] = User[0][user][-maxlen-3:-2]
-            user_train[1][user] = User[1][user][-maxlen-3:-2]
-            user_train[2][user] = User[2][user][-maxlen-3:-2]
-            user_train[3][user] = list(np.argsort(temp[:-2][-maxlen:]) + 1)
-            user_valid[0][user] = User[0][user][-2]
-            user_valid[1][user] = User[1][user][-2]
-            user_valid[2][user] = User[2][user][-2]
-            user_valid[3][user] = list(np.argsort(temp[:-1][-maxlen:]) + 1)
-            user_valid[3][user] = list(np.zeros(maxlen - len(user_valid[3][user]))) + user_valid[3][user]
-        else:
-            user_train[0][user] = User[0][user][-maxlen-2:-1]
-            user_train[1][user] = User[1][user][-maxlen-2:-1]
-            user_train[2][user] = User[2][user][-maxlen-2:-1]
-            user_train[3][user] = list(np.argsort(temp[:-1][-maxlen:]) + 1)
-            user_valid[0][user] = 0
-            user_valid[1][user] = 0
-            user_valid[2][user] = 0
-            user_valid[3][user] = []
-        user_test[0][user] = User[0][user][-1]
-        user_test[1][user] = User[1][user][-1]
-        user_test[2][user] = User[2][user][-1]
-        user_test[3][user] = list(np.argsort(temp[-maxlen:]) + 1)
-        user_train[0][user] = list(np.zeros(1 + maxlen - len(user_train[0][user])).astype(int)) + user_train[0][user]
-        user_train[1][user] = list(np.zeros(1 + maxlen - len(user_train[1][user]))) + user_train[1][user]
-        user_train[2][user] = list(np.zeros(1 + maxlen - len(user_train[2][user]))) + user_train[2][user]
-        user_train[3][user] = list(np.zeros(maxlen - len(user_train[3][user]))) + user_train[3][user]
-        user_test[3][user] = list(np.zeros(maxlen - len(user_test[3][user]))) + user_test[3][user]
+    held = 2 if sparse_name == '' or override_sparse else 1
+    columns = [items, time4, time6]
+    user_train = tuple(UserHistories(col, offsets, maxlen + 1, held) for col in columns) + (time_gap_ranks(times, offsets, maxlen, held),)
+    if held == 2:
+        user_valid = tuple(held_out(col, offsets, 2) for col in columns) + (time_gap_ranks(times, offsets, maxlen, 1),)
+    else:
+        user_valid = tuple(np.zeros(usernum + 1, dtype=np.int32) for _ in columns) + (UserHistories(np.zeros(0, dtype=np.int32), np.zeros(usernum + 2, dtype=np.int64), maxlen),)
+    user_test = tuple(held_out(col, offsets, 1) for col in columns) + (time_gap_ranks(times, offsets, maxlen, 0),)
     return [user_train, user_valid, user_test, usernum, itemnum]
 
 
 
-def data_partition(fname, maxlen, sparse_name = '', override_sparse=False, mod=''):
+def data_partition(fname, maxlen, sparse_name = '', override_sparse=False, mod='', users=None):
     """
     dataset pre-processing that uses coarse time index and fine time index
     refer to data/data.py for dataset formatting
     """
 
-    usernum = 0
-    itemnum = 0
-    User = [defaultdict(list), defaultdict(list), defaultdict(list)]
-    user_dict = {}
-    user_train = ({}, {}, {})
-    user_valid = ({}, {}, {})
-    user_test = ({}, {}, {})
     if sparse_name != '':
-        f = open(f"../data/{fname}_{sparse_name}intwtime{mod}.csv", "r")
+        csv_path = f"../data/{fname}_{sparse_name}intwtime{mod}.csv"
     else:
-        f = open(f"../data/{fname}_int2{mod}.csv", "r")
-
-    for line in f:
-        if sparse_name != '':
-            u, i, t, t2, _ = line.rstrip().split(",")
-        else:
-            u, i, t, t2 = line.rstrip().split(",")
-        u = int(u) + 1
-        if u >= 40000:
-            continue
-        i = int(i) + 1
-        t = int(t)
-        t2 = int(t2)
-        usernum = max(u, usernum)
-        itemnum = max(i, itemnum)
-        User[0][u].append(i)
-        User[1][u].append(t)
-        User[2][u].append(t2)
-
-    for user in User[0]:
-        if sparse_name != '' and not override_sparse:
-            user_train[0][user] = User[0][user][-maxlen-3:-1]
-            user_train[1][user] = User[1][user][-maxlen-3:-1]
-            user_train[2][user] = User[2][user][-maxlen-3:-1]
-            user_valid[0][user] = 0 
-            user_valid[1][user] = 0 
-            user_valid[2][user] = 0 
-        else:
-            user_train[0][user] = User[0][user][-maxlen-3:-2]
-            user_train[1][user] = User[1][user][-maxlen-3:-2]
-            user_train[2][user] = User[2][user][-maxlen-3:-2]
-            user_train[0][user] = list(np.zeros(1 + maxlen - len(user_train[0][user])).astype(int)) + user_train[0][user]
-            user_train[1][user] = list(np.zeros(1 + maxlen - len(user_train[1][user]))) + user_train[1][user]
-            user_train[2][user] = list(np.zeros(1 + maxlen - len(user_train[2][user]))) + user_train[2][user]
-            user_valid[0][user] = User[0][user][-2]
-            user_valid[1][user] = User[1][user][-2]
-            user_valid[2][user] = User[2][user][-2]
-        user_test[0][user] = User[0][user][-1]
-        user_test[1][user] = User[1][user][-1]
-        user_test[2][user] = User[2][user][-1]
-        user_train[0][user] = list(np.zeros(1 + maxlen - len(user_train[0][user])).astype(int)) + user_train[0][user]
-        user_train[1][user] = list(np.zeros(1 + maxlen - len(user_train[1][user]))) + user_train[1][user]
-        user_train[2][user] = list(np.zeros(1 + maxlen - len(user_train[2][user]))) + user_train[2][user]
+        csv_path = f"../data/{fname}_int2{mod}.csv"
+    columns, offsets, usernum, itemnum = read_user_histories(fname, sparse_name, mod, csv_path, ["item", "time4", "time6"], users)
+
+    held = 1 if sparse_name != '' and not override_sparse else 2
+    user_train = tuple(UserHistories(col, offsets, maxlen + 1, held) for col in columns)
+    if held == 2:
+        user_valid = tuple(held_out(col, offsets, 2) for col in columns)
+    else:
+        user_valid = tuple(np.zeros(usernum + 1, dtype=np.int32) for _ in columns)
+    user_test = tuple(held_out(col, offsets, 1) for col in columns)
     return [user_train, user_valid, user_test, usernum, itemnum]
 
 
 
-def data_partition2(fname, sparse_name, override_sparse, mod=''):
+def split_unpadded(fname, sparse_name, override_sparse, mod, users, min_length=None):
     """
-    dataset pre-processing without time 
-    refer to data/data.py for dataset formatting
+    item histories split into train, valid and test UserHistories without padding
+    valid is empty for every user when the shortest history is under 5 interactions, unless override_sparse
+    min_length is the shortest history over every user, taken from the histories read when None
     """
-
-    usernum = 0
-    itemnum = 0
-    User = defaultdict(list)
-    user_train = {}
-    user_valid = {}
-    user_test = {}
     if sparse_name != '':
-        f = open(f"../data/{fname}_{sparse_name}intwtime{mod}.csv", "r")
+        csv_path = f"../data/{fname}_{sparse_name}intwtime{mod}.csv"
     else:
-        f = open(f"../data/{fname}_int2{mod}.csv", "r")
-    for line in f:
-        u, i = line.rstrip().split(",")[0:2]
-        u = int(u) + 1
-        i = int(i) + 1
-        usernum = max(u, usernum)
-        itemnum = max(i, itemnum)
-        User[u].append(i)
-
-    min_list_key = min(User, key=lambda k: len(User[k]))
-    min_length = len(User[min_list_key])
+        csv_path = f"../data/{fname}_int2{mod}.csv"
+    (items,), offsets, usernum, itemnum = read_user_histories(fname, sparse_name, mod, csv_path, ["item"], users)
+
+    if min_length is None:
+        lens = np.diff(offsets)
+        min_length = lens[lens > 0].min()
     if min_length < 5 and not override_sparse:
         sparse = True
     else:
         sparse = False
 
-    for user in User:
-        # nfeedback = len(User[user])
-        if sparse:
-            user_train[user] = User[user][:-1]
-            user_valid[user] = []
-        else:
-            user_train[user] = User[user][:-2]
-            user_valid[user] = [User[user][-2]]
-        user_test[user] = [User[user][-1]]
+    test = held_out(items, offsets, 1)
+    user_test = UserHistories(test, np.arange(len(test) + 1))
+    if sparse:
+        user_train = UserHistories(items, offsets, stop=1)
+        user_valid = UserHistories(test[:0], np.zeros(len(test) + 1, dtype=np.int64))
+    else:
+        user_train = UserHistories(items, offsets, stop=2)
+        valid = held_out(items, offsets, 2)
+        user_valid = UserHistories(valid, np.arange(len(valid) + 1))
+    return user_train, user_valid, user_test, usernum, itemnum
+
+
+def data_partition2(fname, sparse_name, override_sparse, mod='', users=None, min_length=None):
+    """
+    dataset pre-processing without time 
+    refer to data/data.py for dataset formatting
+    """
+
+    user_train, user_valid, user_test, usernum, itemnum = split_unpadded(fname, sparse_name, override_sparse, mod, users, min_length)
     return [user_train, user_valid, user_test, usernum, itemnum]
 
 
-def data_partition3(fname, maxlen, sparse_name, override_sparse, mod=''):
+def data_partition3(fname, maxlen, sparse_name, override_sparse, mod='', users=None, min_length=None):
     """
     dataset pre-processing without time but with sequence lengths
     refer to data/data.py for dataset formatting
     """
 
-    usernum = 0
-    itemnum = 0
-    User = defaultdict(list)
-    user_train = {}
-    user_valid = {}
-    user_test = {}
-    if sparse_name != '':
-        f = open(f"../data/{fname}_{sparse_name}intwtime{mod}.csv", "r")
-    else:
-        f = open(f"../data/{fname}_int2{mod}.csv", "r")
-    for line in f:
-        u, i = line.rstrip().split(",")[0:2]
-        u = int(u) + 1
-        i = int(i) + 1
-        usernum = max(u, usernum)
-        itemnum = max(i, itemnum)
-        User[u].append(i)
-
-    min_list_key = min(User, key=lambda k: len(User[k]))
-    min_length = len(User[min_list_key])
-    if min_length < 5 and not override_sparse:
-        sparse = True
-    else:
-        sparse = False
-
+    user_train, user_valid, user_test, usernum, itemnum = split_unpadded(fname, sparse_name, override_sparse, mod, users, min_length)
     userlens = np.zeros(usernum+1, dtype=int)
-    for user in User:
-        if sparse:
-            user_train[user] = User[user][:-1]
-            user_valid[user] = []
-        else:
-            user_train[user] = User[user][:-2]
-            user_valid[user] = [User[user][-2]]
-        user_test[user] = [User[user][-1]]
-        userlens[user] = min(maxlen, len(user_train[user])-1)
+    userlens[1:] = np.minimum(maxlen, user_train.lengths()[1:] - 1)
     return [user_train, user_valid, user_test, usernum, itemnum, userlens]
+
+
+
+PARTITION_CACHE_VERSION = 2
+
+
+def source_fingerprint(paths, block=1 << 20):
+    """
+    size, mtime and a hash of the first and last block of each path, None for paths that do not exist
+    """
+    fingerprint = []
+    for path in paths:
+        if not os.path.exists(path):
+            fingerprint.append((path, None))
+            continue
+        stat = os.stat(path)
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            digest.update(f.read(block))
+            if stat.st_size > block:
+                f.seek(max(block, stat.st_size - block))
+                digest.update(f.read(block))
+        fingerprint.append((path, stat.st_size, stat.st_mtime_ns, digest.hexdigest()))
+    return fingerprint
+
+
+def dataset_layout(dataset, store):
+    """
+    picklable description of a dataset (UserHistories, arrays and nested tuples/lists of them) with every
+    distinct array replaced by store(array), arrays shared between splits are stored once
+    """
+    refs = {}
+
+    def array(values):
+        if id(values) not in refs:
+            refs[id(values)] = store(values)
+        return refs[id(values)]
+
+    def layout(obj):
+        if isinstance(obj, UserHistories):
+            return ("histories", array(obj.values), array(obj.offsets), obj.width, obj.stop)
+        if isinstance(obj, np.ndarray):
+            return ("array", array(obj))
+        if isinstance(obj, (tuple, list)):
+            return (type(obj).__name__, [layout(item) for item in obj])
+        return ("value", obj)
+
+    return layout(dataset)
+
+
+def build_dataset(spec, load):
+    """
+    inverse of dataset_layout, load(ref) returns the array stored under ref
+    """
+    arrays = {}
+
+    def array(ref):
+        key = repr(ref)
+        if key not in arrays:
+            arrays[key] = load(ref)
+        return arrays[key]
+
+    def build(spec):
+        kind = spec[0]
+        if kind == "histories":
+            return UserHistories(array(spec[1]), array(spec[2]), spec[3], spec[4])
+        if kind == "array":
+            return array(spec[1])
+        if kind == "tuple":
+            return tuple(build(item) for item in spec[1])
+        if kind == "list":
+            return [build(item) for item in spec[1]]
+        return spec[1]
+
+    return build(spec)
+
+
+def save_partition(path, dataset):
+    """
+    write a partitioned dataset as one .npy per distinct array plus a pickled layout, arrays shared between splits are saved once
+    the directory is assembled next to path and renamed into place so concurrent runs never see a partial cache
+    """
+    parent = os.path.dirname(path)
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent)
+    names = []
+
+    def store(values):
+        names.append(f"{len(names)}.npy")
+        np.save(os.path.join(tmp, names[-1]), np.ascontiguousarray(values))
+        return names[-1]
+
+    with open(os.path.join(tmp, "partition.pickle"), "wb") as handle:
+        pickle.dump(dataset_layout(dataset, store), handle, protocol=pickle.HIGHEST_PROTOCOL)
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # another run wrote the same cache first
+        shutil.rmtree(tmp)
+
+
+def load_partition(path):
+    """
+    read a dataset written by save_partition with every array memory-mapped
+    """
+    with open(os.path.join(path, "partition.pickle"), "rb") as handle:
+        spec = pickle.load(handle)
+    return build_dataset(spec, lambda name: np.load(os.path.join(path, name), mmap_mode="r"))
+
+
+def share_dataset(dataset):
+    """
+    copy every array of a dataset into its own shared memory block
+    returns a small picklable spec for attach_dataset and the blocks, which the owner closes and unlinks with release_blocks
+    """
+    blocks = []
+
+    def store(values):
+        values = np.ascontiguousarray(values)
+        block = shared_memory.SharedMemory(create=True, size=max(1, values.nbytes))
+        np.ndarray(values.shape, values.dtype, buffer=block.buf)[...] = values
+        blocks.append(block)
+        return (block.name, values.shape, values.dtype.str)
+
+    return dataset_layout(dataset, store), blocks
+
+
+def attach_dataset(spec):
+    """
+    rebuild a dataset from a share_dataset spec with arrays that are views of the shared blocks, nothing is copied
+    returns the dataset and the attached blocks, which have to stay referenced while the dataset is used
+    """
+    blocks = []
+
+    def load(ref):
+        name, shape, dtype = ref
+        blocks.append(attach_block(name))
+        return np.ndarray(shape, dtype, buffer=blocks[-1].buf)
+
+    return build_dataset(spec, load), blocks
+
+
+def attach_block(name):
+    try:
+        # the creating process owns the block, attaching must not register it for cleanup again
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def release_blocks(blocks):
+    for block in blocks:
+        try:
+            block.close()
+        except BufferError:
+            # arrays handed out still view the block, the mapping goes away with them
+            pass
+        try:
+            block.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def partition_csv(partition, fname, sparse_name, mod):
+    """
+    interaction csv a data_partition* function reads when there is no columnar store
+    """
+    if partition is data_partition_wtime or sparse_name != '':
+        return f"../data/{fname}_{sparse_name}intwtime{mod}.csv"
+    return f"../data/{fname}_int2{mod}.csv"
+
+
+def cached_partition(partition, *args, **kwargs):
+    """
+    partition(*args, **kwargs) memoized on disk under ../data/{fname}_{sparse_name}partition{mod}/
+    keyed by the partition function, its arguments and a fingerprint of the interaction csv and columnar store it reads
+    warm starts memory-map the cached arrays instead of rebuilding them
+    """
+    params = inspect.signature(partition).bind(*args, **kwargs)
+    params.apply_defaults()
+    params = params.arguments
+    if params.get("std"):
+        return partition(*args, **kwargs)
+    fname, sparse_name, mod = params["fname"], params["sparse_name"], params["mod"]
+    csv_path = partition_csv(partition, fname, sparse_name, mod)
+    store_path = f"../data/{fname}_{sparse_name}intwtime{mod}/offsets.npy"
+    key = repr((PARTITION_CACHE_VERSION, partition.__name__, sorted(params.items()), source_fingerprint([csv_path, store_path])))
+    path = f"../data/{fname}_{sparse_name}partition{mod}/{hashlib.sha1(key.encode()).hexdigest()}"
+    if os.path.exists(os.path.join(path, "partition.pickle")):
+        return load_partition(path)
+    dataset = partition(*args, **kwargs)
+    save_partition(path, dataset)
+    return dataset
+
+
+def history_lengths(fname, sparse_name, mod, csv_path):
+    """
+    number of interactions of every user indexed by user id + 1 (0 for user 0), and itemnum
+    read from the offsets of the columnar store when present, otherwise counted from csv_path
+    """
+    cols = load_interactions(fname, sparse_name, mod)
+    if cols is not None:
+        lens = np.diff(cols["offsets"])
+        itemnum = int(cols["item"].max()) + 1 if len(cols["item"]) > 0 else 0
+    else:
+        users = []
+        itemnum = 0
+        f = open(csv_path, "r")
+        for line in f:
+            row = line.split(",", 2)
+            users.append(int(row[0]))
+            itemnum = max(itemnum, int(row[1]) + 1)
+        lens = np.bincount(np.array(users, dtype=np.int64))
+    return np.concatenate(([0], lens)), itemnum
+
+
+class UserShards(object):
+    """
+    a partitioned dataset split into user id ranges, shard k holds users bounds[k] <= u < bounds[k + 1]
+    indexing partitions (or memory-maps from the partition cache) one shard at a time through load(users=(lo, hi))
+    usernum and itemnum cover all shards, and every shard reports the global itemnum
+    lens holds the number of interactions of every user id, as from history_lengths
+    """
+
+    def __init__(self, load, bounds, usernum, itemnum, lens):
+        self.load = load
+        self.bounds = bounds
+        self.usernum = usernum
+        self.itemnum = itemnum
+        self.lens = lens
+
+    def __len__(self):
+        return len(self.bounds) - 1
+
+    def interactions(self):
+        """
+        number of interactions of the users of each shard
+        """
+        total = np.concatenate(([0], np.cumsum(self.lens)))
+        return total[self.bounds[1:]] - total[self.bounds[:-1]]
+
+    def __getitem__(self, k):
+        if k >= len(self):
+            raise IndexError(k)
+        dataset = self.load(users=(int(self.bounds[k]), int(self.bounds[k + 1])))
+        dataset[4] = self.itemnum
+        return dataset
+
+
+def sharded_partition(partition, num_shards, *args, cache=True):
+    """
+    UserShards over partition(*args) with num_shards contiguous user id ranges of roughly equal interaction counts
+    only one shard needs to be in memory at a time, so every user is kept however large the dataset
+    """
+    params = inspect.signature(partition).bind(*args)
+    params.apply_defaults()
+    fname, sparse_name, mod = params.arguments["fname"], params.arguments["sparse_name"], params.arguments["mod"]
+    lens, itemnum = history_lengths(fname, sparse_name, mod, partition_csv(partition, fname, sparse_name, mod))
+    present = np.nonzero(lens)[0]
+    usernum = int(present[-1]) if len(present) > 0 else 0
+    total = np.cumsum(lens[:usernum + 1])
+    cuts = np.searchsorted(total, total[-1] * np.arange(1, num_shards) / num_shards, side="right")
+    bounds = np.unique(np.concatenate(([1], np.clip(cuts, 1, usernum + 1), [usernum + 1])))
+    kwargs = {}
+    if "min_length" in inspect.signature(partition).parameters:
+        # a shard decides on sparsity from every user so all shards split alike
+        kwargs["min_length"] = int(lens[present].min()) if len(present) > 0 else None
+    load = functools.partial(cached_partition, partition, *args, **kwargs) if cache else functools.partial(partition, *args, **kwargs)
+    return UserShards(load, bounds, usernum, itemnum, lens[:usernum + 1])
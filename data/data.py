@@ -13,31 +13,334 @@ from sklearn.utils.extmath import randomized_svd
 from sklearn.preprocessing import normalize
 from scipy.sparse import csr_matrix
 import sys
+import os
 import pdb
 import pickle
+import shutil
+import tempfile
 from operator import itemgetter
-
-def filter_g_k_one(data,k=10,u_name='user_id',i_name='business_id',y_name='stars'):
-    item_group = data.groupby(i_name).agg({y_name:'count'})
-    item_g10 = item_group[item_group[y_name]>=k].index
-    data_new = data[data[i_name].isin(item_g10)]
-    user_group = data_new.groupby(u_name).agg({y_name:'count'})
-    user_g10 = user_group[user_group[y_name]>=k].index
-    data_new = data_new[data_new[u_name].isin(user_g10)]
-    return data_new
-
-def filter_tot(data,k=10,u_name='user_id',i_name='business_id',y_name='stars'):
-    data_new=data
+from dateutil.tz import gettz
+# popularity table helpers shared with the model loaders in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tables import save_table, load_table
+
+def filter_kcore(data,k=10,u_name='user_id',i_name='business_id',y_name='stars'):
+    """
+    keeps the rows whose user and item both have at least k ratings after repeatedly dropping users/items below k
+    found by peeling a sparse node-edge incidence matrix instead of repeated groupby passes
+    each round removes every user/item below k and only touches the edges of the removed nodes
+    """
+    if len(data) == 0:
+        return data
+    _, user_idx = np.unique(data[u_name].values, return_inverse=True)
+    _, item_idx = np.unique(data[i_name].values, return_inverse=True)
+    num_users, num_edges = user_idx.max() + 1, len(data)
+    # users and items share one node id space, items come after users
+    ends = np.stack((user_idx, item_idx + num_users))
+    incidence = csr_matrix((np.ones(2 * num_edges), (ends.ravel(), np.tile(np.arange(num_edges), 2))))
+    # degrees follow the count aggregation, rows with a missing y_name don't count
+    weights = data[y_name].notna().values.astype(int)
+    degree = np.bincount(ends.ravel(), weights=np.tile(weights, 2), minlength=incidence.shape[0])
+    alive = np.ones(num_edges, dtype=bool)
+    removed = degree < k
+    queue = np.nonzero(removed)[0]
+    iters = 0
+    while queue.size > 0:
+        iters += 1
+        edges = np.unique(incidence[queue].indices)
+        edges = edges[alive[edges]]
+        alive[edges] = False
+        degree -= np.bincount(ends[:, edges].ravel(), weights=np.tile(weights[edges], 2), minlength=len(degree))
+        queue = np.nonzero((degree < k) & ~removed)[0]
+        removed[queue] = True
+    print(f'{k}-core filtering: {iters} iterations, removed {num_edges - alive.sum()} of {num_edges} rows')
+    return data[alive]
+
+def period_counts(ao, period, items, num_periods=None):
+    """
+    (periods x items) interaction counts, columns follow the sorted item ids in items
+    """
+    rows = ao[period].values.astype(int)
+    cols = np.searchsorted(items, ao.item.values)
+    if num_periods is None:
+        num_periods = rows.max() + 1
+    counts = np.bincount(rows * len(items) + cols, minlength=num_periods * len(items))
+    return counts.reshape((num_periods, len(items))).astype(float)
+
+def weighted_counts(counts, weight):
+    # exponentially weighted counts, each period decays the previous total by weight
+    vals = counts.copy()
+    for i in range(1, vals.shape[0]):
+        vals[i] += weight * vals[i - 1]
+    return vals
+
+def rolling_counts(counts, window=4):
+    # counts over the current and previous window-1 periods
+    vals = np.cumsum(counts, axis=0)
+    vals[window:] -= vals[:-window].copy()
+    return vals
+
+def percentile_ranks(vals, seen, reverse=False):
+    """
+    per-period percentile rank of each item among items seen up to that period, 0 for items not yet seen
+    """
+    # unseen items are ranked below every seen item, so removing their count gives the rank among seen items
+    num_seen = seen.sum(axis=1, keepdims=True)
+    ranks = rankdata(np.where(seen, vals, -1), "average", axis=1) - (vals.shape[1] - num_seen)
+    percs = 100 * ranks / np.maximum(num_seen, 1)
+    if reverse:
+        percs = 100 - percs
+    return np.where(seen, percs, 0)
+
+def long_format(percs, items, start=0):
+    # (period, item, perc) rows as written by the original per-period loop
+    return np.column_stack((np.repeat(np.arange(start, start + percs.shape[0]), percs.shape[1]), np.tile(items, percs.shape[0]), percs.ravel()))
+
+def widen(arr, width):
+    # zero-pad the item (last) axis of saved state for items added since it was saved
+    return np.pad(arr, [(0, 0)] * (arr.ndim - 1) + [(0, width - arr.shape[-1])])
+
+def extend_map(keys, values):
+    """
+    ids of values under an id map stored as its array of keys (id = position in keys)
+    values not in keys get new ids after the existing ones in sorted order, returns the ids and the extended keys
+    """
+    ids = pd.Index(keys).get_indexer(values)
+    new_keys = np.unique(values[ids == -1])
+    ids[ids == -1] = len(keys) + np.searchsorted(new_keys, values[ids == -1])
+    return ids, np.concatenate((keys, new_keys))
+
+def extend_table(path, rows, keep, table_format='both'):
+    """
+    write rows after the first keep rows of the saved table at path, keep=0 writes rows as a new table
+    kept rows are zero-padded for items added since the table was saved
+    """
+    if keep > 0:
+        rows = np.concatenate((widen(kept_rows(path, keep, table_format), rows.shape[1]), rows))
+    save_table(path, rows, table_format)
+
+def extend_long_table(path, percs, items, start, old_items, table_format='both'):
+    """
+    extend_table for a long_format table of percs from period start on, the kept periods (saved with old_items)
+    get zero-perc rows for items added since the table was saved, like a full rebuild would write
+    """
+    if start > 0:
+        old = kept_rows(path, start * len(old_items), table_format)[:, 2].reshape(start, len(old_items))
+        wide = np.zeros((start, len(items)))
+        wide[:, np.searchsorted(items, old_items)] = old
+        percs = np.concatenate((wide, percs))
+    save_table(path, long_format(percs, items), table_format)
+
+def kept_rows(path, keep, table_format='both'):
+    # the .npy copy is float32, so rows rewritten to the text table come from the text table itself
+    if table_format in ['txt', 'both'] and os.path.exists(path):
+        return np.loadtxt(path, ndmin=2)[:keep]
+    return np.array(load_table(path)[:keep])
+
+# interaction rows kept on disk by the streaming ingestion, ids are provisional until filtering is done
+spill_dtype = np.dtype([('row', 'i8'), ('item', 'i8'), ('user', 'i8'), ('valid', '?'), ('time', 'f8'),
+                        ('time3', 'f8'), ('time5', 'f8'), ('time4', 'i8'), ('time6', 'i8')])
+
+def spill(path, recs, mode='ab'):
+    with open(path, mode) as handle:
+        recs.tofile(handle)
+
+def unspill(path):
+    if not os.path.exists(path):
+        return np.zeros(0, dtype=spill_dtype)
+    return np.fromfile(path, dtype=spill_dtype)
+
+def sorted_ids(keys, keep):
+    # ids of the kept keys in sorted key order (as the dict id maps assign them), -1 for dropped keys
+    kept = np.nonzero(keep)[0]
+    kept = kept[np.argsort(keys[kept], kind='stable')]
+    ids = np.full(len(keys), -1)
+    ids[kept] = np.arange(len(kept))
+    return ids, keys[kept]
+
+def stream_interactions(path, out_prefix, args, state, k=5):
+    """
+    default-mode preprocessing of a csv that doesn't fit in memory, read in chunks of args.chunksize rows
+    interactions are spilled to disk partitioned by user (for deduplication and k-core filtering) and then by time
+    (for writing the sorted csvs), so only the id maps, period counts and one partition are held in memory
+    writes the same _intwtime/_int2 csvs and rawpop table, fills state and returns the items and their period counts
+    """
+    spill_dir = tempfile.mkdtemp(dir=os.path.dirname(out_prefix) or '.')
+    buckets = [os.path.join(spill_dir, f'user{b}.bin') for b in range(args.num_buckets)]
+    # provisional ids in order of appearance, rows partitioned by user
+    item_keys, user_keys, num_rows, time_is_int = None, None, 0, True
+    for chunk in pd.read_csv(path, chunksize=args.chunksize):
+        chunk.columns = ["item", "user", "rate", "time"]
+        if item_keys is None:
+            item_keys, user_keys = chunk.item.values[:0], chunk.user.values[:0]
+        recs = np.zeros(len(chunk), dtype=spill_dtype)
+        recs['row'] = np.arange(num_rows, num_rows + len(chunk))
+        recs['item'], item_keys = extend_map(item_keys, chunk.item.values)
+        recs['user'], user_keys = extend_map(user_keys, chunk.user.values)
+        recs['valid'] = chunk.rate.notna().values
+        recs['time'] = chunk.time.values
+        time_is_int &= pd.api.types.is_integer_dtype(chunk.time)
+        part = recs['user'] % args.num_buckets
+        for b in np.unique(part):
+            spill(buckets[b], recs[part == b])
+        num_rows += len(chunk)
+    # repeated (item, user) pairs share a partition, keep the first as drop_duplicates does
+    num_unique = 0
+    for b in buckets:
+        recs = unspill(b)
+        _, first = np.unique(recs['item'] * len(user_keys) + recs['user'], return_index=True)
+        num_unique += len(first)
+        spill(b, recs[np.sort(first)], 'wb')
+    # k-core filtering, each round drops every user/item below k (same core as filter_kcore)
+    item_alive, user_alive = np.ones(len(item_keys), dtype=bool), np.ones(len(user_keys), dtype=bool)
+    iters = 0
     while True:
-        data_new = filter_g_k_one(data_new,k=k,u_name=u_name,i_name=i_name,y_name=y_name)
-        m1 = data_new.groupby(i_name).agg({y_name:'count'})
-        m2 = data_new.groupby(u_name).agg({y_name:'count'})
-        num1 = m1[y_name].min()
-        num2 = m2[y_name].min()
-        print('item min:',num1,'user min:',num2)
-        if num1>=k and num2>=k:
+        iters += 1
+        item_deg, user_deg = np.zeros(len(item_keys)), np.zeros(len(user_keys))
+        for b in buckets:
+            recs = unspill(b)
+            recs = recs[item_alive[recs['item']] & user_alive[recs['user']] & recs['valid']]
+            item_deg += np.bincount(recs['item'], minlength=len(item_keys))
+            user_deg += np.bincount(recs['user'], minlength=len(user_keys))
+        if (item_deg[item_alive] >= k).all() and (user_deg[user_alive] >= k).all():
             break
-    return data_new
+        item_alive &= item_deg >= k
+        user_alive &= user_deg >= k
+    item_ids, state['item_keys'] = sorted_ids(item_keys, item_alive)
+    user_ids, state['user_keys'] = sorted_ids(user_keys, user_alive)
+    # final ids, raw popularity over all kept rows, then the time filter
+    rawpop = np.zeros(len(state['item_keys']), dtype=int)
+    tmin, tmax, num_kept, num_timed, samples = np.inf, -np.inf, 0, 0, []
+    for b in buckets:
+        recs = unspill(b)
+        recs = recs[item_alive[recs['item']] & user_alive[recs['user']]]
+        recs['item'], recs['user'] = item_ids[recs['item']], user_ids[recs['user']]
+        rawpop += np.bincount(recs['item'], minlength=len(rawpop))
+        num_kept += len(recs)
+        recs = recs[recs['time'] > 12]
+        num_timed += len(recs)
+        if len(recs) > 0:
+            tmin, tmax = min(tmin, recs['time'].min()), max(tmax, recs['time'].max())
+            # sorted sample of times for splitting the output into time ranges of about chunksize rows
+            samples.append(np.sort(recs['time'])[::max(1, args.chunksize // 100)])
+        spill(b, recs, 'wb')
+    print(f'{k}-core filtering: {iters} iterations, removed {num_unique - num_kept} of {num_unique} rows')
+    state['rawpop'] = rawpop
+    save_table(f'{out_prefix}_rawpop.txt', np.array([rawpop]), args.table_format)
+    # seconds or milliseconds is decided over all rows like to_datetime
+    unit = timestamp_unit([tmin, tmax])
+    time3_keys, time5_keys, items = np.zeros(0), np.zeros(0), np.zeros(len(rawpop), dtype=bool)
+    for b in buckets:
+        recs = unspill(b)
+        time2 = to_datetime(pd.Series(recs['time']), unit)
+        recs['time3'] = period_key(time2, args.t1_cutoff, args.day_shift, args.hour_shift)
+        recs['time5'] = period_key(time2, args.t2_cutoff, args.day_shift, args.hour_shift)
+        time3_keys, time5_keys = np.union1d(time3_keys, recs['time3']), np.union1d(time5_keys, recs['time5'])
+        items[recs['item']] = True
+        spill(b, recs, 'wb')
+    state['time3_keys'], state['time5_keys'] = time3_keys, time5_keys
+    if args.stop_early:
+        print(args.dataset.split('/')[-1], args.mode, args.sparse_val, 0, len(time3_keys) - 1, 0, len(time5_keys) - 1)
+        shutil.rmtree(spill_dir)
+        sys.exit()
+    items = np.nonzero(items)[0]
+    counts = {'time4': np.zeros((len(time3_keys), len(items))), 'time6': np.zeros((len(time5_keys), len(items)))}
+    num_groups = -(-num_timed // args.chunksize)
+    bounds = np.quantile(np.concatenate(samples), np.arange(1, num_groups) / num_groups) if num_groups > 1 else np.zeros(0)
+    groups = [os.path.join(spill_dir, f'time{g}.bin') for g in range(len(bounds) + 1)]
+    for b in buckets:
+        recs = unspill(b)
+        recs['time4'], recs['time6'] = np.searchsorted(time3_keys, recs['time3']), np.searchsorted(time5_keys, recs['time5'])
+        frame = pd.DataFrame({'time4': recs['time4'], 'time6': recs['time6'], 'item': recs['item']})
+        counts['time4'] += period_counts(frame, 'time4', items, len(time3_keys))
+        counts['time6'] += period_counts(frame, 'time6', items, len(time5_keys))
+        part = np.searchsorted(bounds, recs['time'], side='right')
+        for g in np.unique(part):
+            spill(groups[g], recs[part == g])
+        os.remove(b)
+    # time ranges in order, each sorted by time with ties kept in input order (the stable sort of the in-memory path)
+    for g, group in enumerate(groups):
+        recs = unspill(group)
+        recs = recs[np.lexsort((recs['row'], recs['time']))]
+        frame = pd.DataFrame({'user': recs['user'], 'item': recs['item'], 'time4': recs['time4'], 'time6': recs['time6'],
+                              'time': recs['time'].astype(int) if time_is_int else recs['time']})
+        mode = 'w' if g == 0 else 'a'
+        frame.to_csv(f'{out_prefix}_intwtime{args.extra2}.csv', header=False, index=False, mode=mode)
+        frame[['user', 'item', 'time4', 'time6']].to_csv(f'{out_prefix}_int2{args.extra2}.csv', header=False, index=False, mode=mode)
+    shutil.rmtree(spill_dir)
+    save_interactions(f'{out_prefix}_intwtime{args.extra2}', lambda: csv_chunks(f'{out_prefix}_intwtime{args.extra2}.csv', args.chunksize))
+    print("saved interaction matrix")
+    return items, counts
+
+def week_adj_percentiles(ao, otmpw, last, cands, batch=1024):
+    """
+    percentiles of each user's candidate items in the fine popularity row of the week before their last interaction,
+    after adding the counts of interactions in their last week that happened before it
+    ao is grouped by week once, counts and ranks are answered with searchsorted instead of a scan per user
+    """
+    num_items = max(ao.item.max(), cands.max()) + 1
+    # sorted (week, item, time rank) keys, interactions of a week/item before a time are a contiguous range
+    times = np.unique(ao.time.values)
+    keys = np.sort((ao.time6.values * num_items + ao.item.values) * (len(times) + 1) + np.searchsorted(times, ao.time.values))
+    last_weeks, last_ranks = last.time6.values, np.searchsorted(times, last.time.values)
+    sorted_rows = np.sort(otmpw, axis=1)
+    percs = np.zeros(cands.shape)
+    for week in np.unique(last_weeks):
+        row, sorted_row = otmpw[week - 1], sorted_rows[week - 1]
+        week_users = np.nonzero(last_weeks == week)[0]
+        for b in range(0, len(week_users), batch):
+            users = week_users[b:b + batch]
+            arr = cands[users]
+            group = (week * num_items + arr) * (len(times) + 1)
+            counts = np.searchsorted(keys, group + last_ranks[users, None]) - np.searchsorted(keys, group)
+            old, new = row[arr], row[arr] + counts
+            # repeated candidates only change the row once
+            order = np.argsort(arr, axis=1, kind='stable')
+            first = np.ones(arr.shape, dtype=bool)
+            first[np.arange(len(users))[:, None], order[:, 1:]] = np.diff(np.take_along_axis(arr, order, axis=1), axis=1) != 0
+            # ranks in the adjusted row, from the sorted unadjusted row with the candidates' old values swapped for new ones
+            first, old, new = first[:, None, :], old[:, None, :], new[:, :, None]
+            less = np.searchsorted(sorted_row, new[..., 0], 'left') + (first & (new.transpose(0, 2, 1) < new)).sum(2) - (first & (old < new)).sum(2)
+            less_equal = np.searchsorted(sorted_row, new[..., 0], 'right') + (first & (new.transpose(0, 2, 1) <= new)).sum(2) - (first & (old <= new)).sum(2)
+            percs[users] = 100 * (less + (less_equal - less + 1) / 2) / len(row)
+    return percs
+
+# columns of the interaction store, timestamps are int64 and the rest int32
+interaction_columns = ['user', 'item', 'time4', 'time6', 'time']
+
+def save_interactions(path, chunks):
+    """
+    columnar copy of an _intwtime csv for the loaders in ../data.py, one .npy per column in the directory path
+    rows are sorted by user then time and offsets.npy gives the rows of user u as offsets[u]:offsets[u+1]
+    chunks() yields dicts of column arrays in csv order, it is called twice (counting rows per user, then filling)
+    """
+    counts = np.zeros(0, dtype=np.int64)
+    for cols in chunks():
+        user_counts = np.bincount(cols['user'].astype(np.int64))
+        width = max(len(counts), len(user_counts))
+        counts = widen(counts, width) + widen(user_counts, width)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    os.makedirs(path, exist_ok=True)
+    out = {name: np.lib.format.open_memmap(os.path.join(path, f'{name}.npy'), mode='w+', shape=(int(offsets[-1]),),
+                                           dtype=np.int64 if name == 'time' else np.int32) for name in interaction_columns}
+    # each chunk's rows go after the rows of the same users from earlier chunks, in csv order
+    fill = offsets[:-1].copy()
+    for cols in chunks():
+        user = cols['user'].astype(np.int64)
+        order = np.argsort(user, kind='stable')
+        pos = fill[user[order]] + np.arange(len(user)) - np.searchsorted(user[order], user[order])
+        for name in interaction_columns:
+            out[name][pos] = cols[name][order]
+        fill += np.bincount(user, minlength=len(fill))
+    for arr in out.values():
+        arr.flush()
+    # written last, loaders only use the store when offsets.npy is newer than the csv
+    np.save(os.path.join(path, 'offsets.npy'), offsets)
+
+def csv_chunks(path, chunksize):
+    # an _intwtime csv as dicts of column arrays for save_interactions
+    for chunk in pd.read_csv(path, header=None, chunksize=chunksize):
+        yield {name: chunk[k].values for k, name in enumerate(interaction_columns)}
 
 def pop_embed(perc, num=10):
     if perc == 0:
@@ -92,6 +395,57 @@ def position_encoding_basis2(perc):
     position_enc[1::2] = np.cos(position_enc[1::2])
     return position_enc
 
+def timestamp_unit(times):
+    # unix timestamps are in seconds, or milliseconds if out of range for seconds
+    try:
+        datetime.fromtimestamp(np.min(times)), datetime.fromtimestamp(np.max(times))
+        return 's'
+    except:
+        return 'ms'
+
+def to_datetime(times, unit=None):
+    """
+    local datetimes of unix timestamps (as datetime.fromtimestamp gives them), converted as datetime64 in one pass
+    """
+    if unit is None:
+        unit = timestamp_unit(times)
+    utc = pd.to_datetime(np.asarray(times), unit=unit, utc=True)
+    return pd.Series(utc.tz_convert(gettz()).tz_localize(None), index=times.index)
+
+def period_key(time2, cutoff, day_shift=False, hour_shift=False):
+    # sortable key of the period each datetime falls in, cutoff sets the period length
+    if day_shift:
+        return np.ceil(time2.dt.dayofyear * 100 + time2.dt.hour / cutoff)
+    elif hour_shift:
+        return np.ceil(time2.dt.dayofyear * 100 + time2.dt.hour * 100 + time2.dt.minute / cutoff)
+    return np.ceil(time2.dt.year * 1000 + time2.dt.dayofyear / cutoff)
+
+def pop_embed_table(percs, num=10):
+    """
+    pop_embed applied to every cell of a (periods x items) percentile matrix, laid out as (periods*(num+1)) x items
+    """
+    rev = 100 // num
+    loc = np.minimum(percs // rev, num).astype(int)
+    rem = percs % rev
+    res = np.zeros((percs.shape[0], num + 1, percs.shape[1]))
+    # percentiles on a bin edge get a single 1, others are split linearly between neighbouring bins
+    p, i = np.nonzero((rem == 0) & (percs != 0))
+    res[p, loc[p, i], i] = 1
+    p, i = np.nonzero((rem != 0) & (loc < num))
+    res[p, loc[p, i], i] = 1 - rem[p, i] / rev
+    res[p, loc[p, i] + 1, i] = rem[p, i] / rev
+    return res.reshape((-1, percs.shape[1]))
+
+def position_encoding_basis_table(percs, basis):
+    """
+    position_encoding_basis (or position_encoding_basis2) applied to every cell of a (periods x items) percentile matrix,
+    laid out as (periods*len(basis)) x items
+    """
+    position_enc = percs[:, None, :] * basis[None, :, None]
+    position_enc[:, 0::2] = np.sin(position_enc[:, 0::2])
+    position_enc[:, 1::2] = np.cos(position_enc[:, 1::2])
+    return position_enc.reshape((-1, percs.shape[1]))
+
 parser = argparse.ArgumentParser()
 parser.add_argument('--dataset', default='../../data/douban/douban_music', type=str)
 parser.add_argument('--mode', default='', type=str, help='sparse,fs,temp_fs')
@@ -120,89 +474,115 @@ parser.add_argument('--use_perc',  action='store_true')
 parser.add_argument('--reverse',  action='store_true')
 parser.add_argument('--day_shift',  action='store_true')
 parser.add_argument('--hour_shift',  action='store_true')
+parser.add_argument('--table_format', default='both', type=str, help='txt,npy,both: popularity tables as text and/or float32 .npy for memory-mapped loading')
+parser.add_argument('--incremental', default='', type=str, help='csv of new interactions (same format as the dataset csv) to append to the tables of a previous default-mode run, using its saved state')
+parser.add_argument('--chunksize', default=0, type=int, help='rows per chunk for streaming ingestion of csvs that do not fit in memory (default mode only), 0 reads the whole csv at once')
+parser.add_argument('--num_buckets', default=16, type=int, help='user partitions spilled to disk by streaming ingestion, each should fit in memory')
 args = parser.parse_args()
 dataset = args.dataset
 
-# each row must have item, user, interaction/rating, time (as unix timestamp) in that order
-ao = pd.read_csv(f'{dataset}.csv')
-ao.columns=["item", "user", "rate", "time"]
-ao = ao.drop_duplicates(['item', 'user'])
 # sparse scenario
 sparse = ''
-if args.mode == 'sparse':
-    # k-core filtering
-    ao = filter_tot(ao,k=5,u_name='user',i_name='item',y_name='rate')
-    ao.sort_values(['time'], inplace=True)
-    train_filt = ao.groupby('user').apply(lambda x: x.iloc[-max(3, int(args.sparse_val/100.0*(len(x)-1)))-1:])
-    test = ao.groupby('user').last()
-    ao = pd.concat([train_filt.reset_index(drop=True), test.reset_index()], axis=0)
-    sparse = f"_sparse_{args.sparse_val}{args.extra}"
-elif args.mode == 'fs':
-    # k-core filtering
-    ao = filter_tot(ao,k=5,u_name='user',i_name='item',y_name='rate')
-    ao.sort_values(['time'], inplace=True)
-    ao = ao.groupby('user').apply(lambda x: x.iloc[:max(3, int(args.sparse_val/100.0*(len(x)-1)))+1]).reset_index(drop=True)
-    sparse = f"_fs_{args.sparse_val}{args.extra}"
-elif args.mode == 'temp_fs':
-    ao.sort_values(['time'], inplace=True)
-    if args.use_ref:
-        temp = pd.read_csv(args.reference)
-        size = temp.shape[0] * args.ref_frac / 100.0
-    else:
-        size = ao.shape[0] * args.sparse_val / 100.0
-    ao = ao.iloc[:int(size)]
-    # k-core filtering
-    ao = filter_tot(ao,k=5,u_name='user',i_name='item',y_name='rate')
-    sparse = f"_temp_fs_{args.sparse_val}{args.extra}"
-else:
-    ao = filter_tot(ao,k=5,u_name='user',i_name='item',y_name='rate')
-# user, item ids
-item_map = dict(zip(sorted(ao.item.unique()), range(len(ao.item.unique()))))
-ao.item = ao.item.apply(lambda x: item_map[x])
-user_map = dict(zip(sorted(ao.user.unique()), range(len(ao.user.unique()))))
-ao.user = ao.user.apply(lambda x: user_map[x])
-
-arr = np.array([ao.groupby('item').apply(lambda x: len(x)).values])
-np.savetxt(f'{dataset}{sparse}_rawpop.txt', arr)
-
-ao = ao[ao.time > 12]
-if args.noise_prop_t > 0:
-    time_std = (ao.time.max() - ao.time.min()) * args.noise_prop_t
-    shrink = 0.5 * (ao.time.max() - ao.time.min()) / (0.5 * (ao.time.max() - ao.time.min()) + 3 * time_std)
-    mean_time = ao.time.mean()
-    ao.time = (ao.time - mean_time) * shrink + mean_time
-    ao.time = (ao.time + np.random.normal(0, time_std, ao.shape[0])).astype(int)
-
-# month and week ids, these horizons can be changed based on dataset
-try:
-    ao['time2'] = ao.time.apply(lambda x: datetime.fromtimestamp(x))
-except:
-    ao['time2'] = ao.time.apply(lambda x: datetime.fromtimestamp(x/1000))
-
-if args.day_shift:
-    ao['time3'] = np.ceil(ao.time2.dt.dayofyear * 100 + ao.time2.dt.hour / args.t1_cutoff)
-elif args.hour_shift:
-    ao['time3'] = np.ceil(ao.time2.dt.dayofyear * 100 + ao.time2.dt.hour * 100 + ao.time2.dt.minute / args.t1_cutoff)
+# id maps, period maps and running popularity counts needed to extend the tables later
+state_path = f'{dataset}{sparse}_popstate{args.extra2}.pickle'
+state = {}
+if args.chunksize > 0:
+    if args.mode != '' or args.incremental != '' or args.noise_prop_t > 0 or args.week_adj:
+        raise ValueError("streaming ingestion only supports the default mode without time noise, --incremental or --week_adj")
+    old_items = np.zeros(0, dtype=int)
+    items, streamed_counts = stream_interactions(f'{dataset}.csv', dataset, args, state)
 else:
-    ao['time3'] = np.ceil(ao.time2.dt.year * 1000 + ao.time2.dt.dayofyear / args.t1_cutoff)
-var_map = dict(zip(sorted(ao['time3'].unique()), range(len(ao['time3'].unique()))))
-ao['time4'] = ao['time3'].apply(lambda x: var_map[x])
-if args.day_shift:
-    ao['time5'] = np.ceil(ao.time2.dt.dayofyear * 100 + ao.time2.dt.hour / args.t2_cutoff)
-elif args.hour_shift:
-    ao['time5'] = np.ceil(ao.time2.dt.dayofyear * 100 + ao.time2.dt.hour * 100 + ao.time2.dt.minute / args.t2_cutoff)
-else:
-    ao['time5'] = np.ceil(ao.time2.dt.year * 1000 + ao.time2.dt.dayofyear / args.t2_cutoff)
-var_map = dict(zip(sorted(ao['time5'].unique()), range(len(ao['time5'].unique()))))
-ao['time6'] = ao['time5'].apply(lambda x: var_map[x])
-if args.stop_early:
-    print(args.dataset.split('/')[-1], args.mode, args.sparse_val, ao.time4.min(), ao.time4.max(), ao.time6.min(), ao.time6.max())
-    sys.exit()
-# interaction matrix processed by model with time embedding
-ao.sort_values(['time2'])[['user', 'item', 'time4', 'time6', 'time']].drop_duplicates().to_csv(f'{dataset}{sparse}_intwtime{args.extra2}.csv', header=False, index=False)
-# interaction matrix processed by model without time embedding
-ao.sort_values(['time2'])[['user', 'item', 'time4', 'time6']].drop_duplicates().to_csv(f'{dataset}{sparse}_int2{args.extra2}.csv', header=False, index=False)
-print("saved interaction matrix")
+    # each row must have item, user, interaction/rating, time (as unix timestamp) in that order
+    ao = pd.read_csv(args.incremental if args.incremental != '' else f'{dataset}.csv')
+    ao.columns=["item", "user", "rate", "time"]
+    ao = ao.drop_duplicates(['item', 'user'])
+    if args.incremental != '':
+        # new interactions are added to the existing (already k-core filtered) ids without refiltering
+        if args.mode != '' or args.noise_prop_t > 0:
+            raise ValueError("incremental refresh only supports the default mode without time noise")
+        with open(state_path, 'rb') as handle:
+            state = pickle.load(handle)
+        for key in ['weight', 't1_cutoff', 't2_cutoff', 'day_shift', 'hour_shift']:
+            if state[key] != getattr(args, key):
+                raise ValueError(f"--{key} differs from the saved popularity state")
+    elif args.mode == 'sparse':
+        # k-core filtering
+        ao = filter_kcore(ao,k=5,u_name='user',i_name='item',y_name='rate')
+        ao.sort_values(['time'], inplace=True)
+        train_filt = ao.groupby('user').apply(lambda x: x.iloc[-max(3, int(args.sparse_val/100.0*(len(x)-1)))-1:])
+        test = ao.groupby('user').last()
+        ao = pd.concat([train_filt.reset_index(drop=True), test.reset_index()], axis=0)
+        sparse = f"_sparse_{args.sparse_val}{args.extra}"
+    elif args.mode == 'fs':
+        # k-core filtering
+        ao = filter_kcore(ao,k=5,u_name='user',i_name='item',y_name='rate')
+        ao.sort_values(['time'], inplace=True)
+        ao = ao.groupby('user').apply(lambda x: x.iloc[:max(3, int(args.sparse_val/100.0*(len(x)-1)))+1]).reset_index(drop=True)
+        sparse = f"_fs_{args.sparse_val}{args.extra}"
+    elif args.mode == 'temp_fs':
+        ao.sort_values(['time'], inplace=True)
+        if args.use_ref:
+            temp = pd.read_csv(args.reference)
+            size = temp.shape[0] * args.ref_frac / 100.0
+        else:
+            size = ao.shape[0] * args.sparse_val / 100.0
+        ao = ao.iloc[:int(size)]
+        # k-core filtering
+        ao = filter_kcore(ao,k=5,u_name='user',i_name='item',y_name='rate')
+        sparse = f"_temp_fs_{args.sparse_val}{args.extra}"
+    else:
+        ao = filter_kcore(ao,k=5,u_name='user',i_name='item',y_name='rate')
+    # user, item ids
+    if args.incremental != '':
+        old_items = state['items']
+        ao['item'], state['item_keys'] = extend_map(state['item_keys'], ao.item.values)
+        ao['user'], state['user_keys'] = extend_map(state['user_keys'], ao.user.values)
+        arr = np.array([widen(state['rawpop'], len(state['item_keys'])) + np.bincount(ao.item, minlength=len(state['item_keys']))])
+    else:
+        old_items = np.zeros(0, dtype=int)
+        # ids in sorted key order
+        ao['item'], state['item_keys'] = pd.factorize(ao.item.values, sort=True)
+        ao['user'], state['user_keys'] = pd.factorize(ao.user.values, sort=True)
+        arr = np.array([ao.groupby('item').apply(lambda x: len(x)).values])
+    state['rawpop'] = arr[0]
+    save_table(f'{dataset}{sparse}_rawpop.txt', arr, args.table_format)
+
+    ao = ao[ao.time > 12]
+    if args.noise_prop_t > 0:
+        time_std = (ao.time.max() - ao.time.min()) * args.noise_prop_t
+        shrink = 0.5 * (ao.time.max() - ao.time.min()) / (0.5 * (ao.time.max() - ao.time.min()) + 3 * time_std)
+        mean_time = ao.time.mean()
+        ao.time = (ao.time - mean_time) * shrink + mean_time
+        ao.time = (ao.time + np.random.normal(0, time_std, ao.shape[0])).astype(int)
+
+    # month and week ids, these horizons can be changed based on dataset
+    ao['time2'] = to_datetime(ao.time)
+    ao['time3'] = period_key(ao.time2, args.t1_cutoff, args.day_shift, args.hour_shift)
+    ao['time5'] = period_key(ao.time2, args.t2_cutoff, args.day_shift, args.hour_shift)
+    if args.incremental != '':
+        # stored periods can't be reopened except the last one, which may have been incomplete
+        if (ao.time3 < state['time3_keys'][-1]).any() or (ao.time5 < state['time5_keys'][-1]).any():
+            raise ValueError("new interactions must not predate the last stored period")
+        ao['time4'], state['time3_keys'] = extend_map(state['time3_keys'], ao.time3.values)
+        ao['time6'], state['time5_keys'] = extend_map(state['time5_keys'], ao.time5.values)
+    else:
+        ao['time4'], state['time3_keys'] = pd.factorize(ao.time3.values, sort=True)
+        ao['time6'], state['time5_keys'] = pd.factorize(ao.time5.values, sort=True)
+    if args.stop_early:
+        print(args.dataset.split('/')[-1], args.mode, args.sparse_val, ao.time4.min(), ao.time4.max(), ao.time6.min(), ao.time6.max())
+        sys.exit()
+    # interaction matrix processed by model with time embedding, new interactions are appended in incremental mode
+    write_mode = 'a' if args.incremental != '' else 'w'
+    ints = ao.sort_values(['time2'], kind='stable')[['user', 'item', 'time4', 'time6', 'time']].drop_duplicates()
+    ints.to_csv(f'{dataset}{sparse}_intwtime{args.extra2}.csv', header=False, index=False, mode=write_mode)
+    # interaction matrix processed by model without time embedding
+    ints[['user', 'item', 'time4', 'time6']].drop_duplicates().to_csv(f'{dataset}{sparse}_int2{args.extra2}.csv', header=False, index=False, mode=write_mode)
+    # columnar copy for the loaders, rebuilt from the whole csv when new interactions were appended to it
+    if args.incremental != '':
+        save_interactions(f'{dataset}{sparse}_intwtime{args.extra2}', lambda: csv_chunks(f'{dataset}{sparse}_intwtime{args.extra2}.csv', 1000000))
+    else:
+        save_interactions(f'{dataset}{sparse}_intwtime{args.extra2}', lambda: [{name: ints[name].values for name in interaction_columns}])
+    print("saved interaction matrix")
 
 if args.last_pop:
     df = pd.read_csv(f'{dataset}{sparse}_int2{args.extra2}.csv', header=None, index_col=False)
@@ -218,42 +598,38 @@ if args.last_pop:
     sys.exit()
 
 if args.week_adj:
-    otmpw = np.loadtxt(f"{dataset}{sparse}_week_curr_raw{args.extra2}.txt")
+    otmpw = np.array(load_table(f"{dataset}{sparse}_week_curr_raw{args.extra2}.txt"), dtype=float)
     with open(f"{dataset}_userneg.pickle", 'rb') as handle:
         usernegs = pickle.load(handle)
     last = ao.groupby('user').last()
     users = sorted(ao.user.unique())
     num = 6 if args.mode2 == "orig" else 7
     df = np.zeros((num * len(users), 101))
-    last_values = last.to_dict('index')
-    start = datetime.now()
-    for u in users:
-        last_u = last_values[u]
-        counter = Counter(ao[(ao['time6'] == last_u['time6']) & (ao['time'] < last_u['time'])]['item'])
-        arr = np.array(usernegs[u + 1]) - 1
-        arr = np.insert(arr, 0, last.iloc[u]['item'])
-        counts = np.array(itemgetter(*arr)(counter))
-        urow = otmpw[last_u['time6'] - 1]
-        urow[arr] += counts
-        percs = 100 * rankdata(urow, "average") / len(urow)
-        if args.mode2 == "orig":
-            df[(args.t2_size + 1) * u:(args.t2_size + 1) * u + (args.t2_size + 1)] = np.array([pop_embed(perc, args.t2_size) for perc in percs[arr]]).T
-        elif args.mode2 == "sin":
-            df[7 * u:7 * u + 7] = np.array([position_encoding_basis2(perc) for perc in percs[arr]]).T
-        elif args.mode2 == "perc":
-            df[u:u + 1] = np.array(percs[arr])/100
+    # last item of each user followed by their evaluation negatives
+    cands = np.column_stack((last.item.values, np.array([usernegs[u + 1] for u in users]) - 1))
+    percs = week_adj_percentiles(ao, otmpw, last, cands)
     if args.mode2 == "orig":
-        np.savetxt(f"{dataset}{sparse}_week_wt_embed_adj{args.extra2}.txt", df)
+        embed = pop_embed_table(percs, args.t2_size)
+        df[:len(embed)] = embed
     elif args.mode2 == "sin":
-        np.savetxt(f"{dataset}{sparse}_week_wtembed_pos_adj{args.extra2}.txt", df)
+        df[:] = position_encoding_basis_table(percs, basis_setup2)
     elif args.mode2 == "perc":
-        np.savetxt(f"{dataset}{sparse}_week_wt_perc_adj{args.extra2}.txt", df)
+        df[:len(users)] = percs / 100
+    if args.mode2 == "orig":
+        save_table(f"{dataset}{sparse}_week_wt_embed_adj{args.extra2}.txt", df, args.table_format)
+    elif args.mode2 == "sin":
+        save_table(f"{dataset}{sparse}_week_wtembed_pos_adj{args.extra2}.txt", df, args.table_format)
+    elif args.mode2 == "perc":
+        save_table(f"{dataset}{sparse}_week_wt_perc_adj{args.extra2}.txt", df, args.table_format)
     sys.exit()
 
 # 3 potential ways to compute popularity over time: just current period, cumulative over periods, exponential weighted average over periods
 # uncomment below sections to run the current period and cumulative periods approaches
-items = sorted(ao.item.unique())
-grouped = ao.groupby('time4')
+if args.chunksize == 0:
+    items = np.sort(ao.item.unique())
+if args.incremental != '':
+    items = np.union1d(state['items'], items)
+state['items'] = items
 
 # ototaldft = pd.DataFrame(columns=["time4", "item", "perc"])
 # for i, ints in grouped:
@@ -278,26 +654,28 @@ grouped = ao.groupby('time4')
 
 if not args.not_coarse:
 
-    ototaldft3 = pd.DataFrame(columns=["time4", "item", "perc"])
-    counter = Counter()
-    for i, ints in grouped:
-        counter = Counter({k:args.weight*v for k,v in counter.items()})
-        counter.update(ints.item)
-        vals = list(counter.values())
-        percs = 100 * rankdata(vals, "average") / len(vals)
-        if args.reverse:
-            percs = 100 - percs
-        noise_mask = np.random.rand(*percs.shape) < args.noise_p
-        percs[noise_mask] += np.random.normal(loc=0, scale=args.noise_std, size=percs[noise_mask].shape)
-        percs = np.clip(percs, 0, 100)
-        item_orders = list(counter.keys())
-        left = list(set(items) - set(item_orders))
-        df = pd.DataFrame({"time4": [i for _ in range(len(items))], "item": item_orders + left, "perc": np.concatenate((percs, np.zeros(len(left))))})
-        ototaldft3 = pd.concat([ototaldft3, df])
+    # exponential weighted average over periods, computed for all periods at once
+    counts = streamed_counts['time4'] if args.chunksize > 0 else period_counts(ao, 'time4', items)
+    if args.incremental != '':
+        # recompute from the last stored period, starting from its decayed counts
+        start = state['coarse_start']
+        prev_vals, prev_seen = widen(state['coarse_base'], len(items)), widen(state['coarse_seen'], len(items))
+        counts = counts[start:]
+        counts[0] += widen(state['coarse_last'], len(items))
+    else:
+        start, prev_vals, prev_seen = 0, np.zeros(len(items)), np.zeros(len(items), dtype=bool)
+    vals = weighted_counts(np.vstack((prev_vals, counts)), args.weight)[1:]
+    seen = prev_seen | (np.cumsum(counts, axis=0) > 0)
+    state.update(coarse_start=start + len(counts) - 1, coarse_last=counts[-1],
+                 coarse_base=vals[-2] if len(counts) > 1 else prev_vals, coarse_seen=seen[-2] if len(counts) > 1 else prev_seen)
+    percs = percentile_ranks(vals, seen, args.reverse)
+    noise_mask = seen & (np.random.rand(*percs.shape) < args.noise_p)
+    percs[noise_mask] += np.random.normal(loc=0, scale=args.noise_std, size=noise_mask.sum())
+    percs = np.clip(percs, 0, 100)
 
     # np.savetxt(f"{dataset}{sparse}_currpop.txt", ototaldft)
     # np.savetxt(f"{dataset}{sparse}_cumpop.txt", ototaldft2)
-    np.savetxt(f"{dataset}{sparse}_{args.name}pop{args.extra2}.txt", ototaldft3)
+    extend_long_table(f"{dataset}{sparse}_{args.name}pop{args.extra2}.txt", percs, items, start, old_items, args.table_format)
     print("saved monthly popularity percentiles")
 
     # construct simple popularity feature based on each of 3 methods
@@ -309,62 +687,61 @@ if not args.not_coarse:
     # np.savetxt(f"{dataset}{sparse}_rawpop.txt", otmp2)
     # otmp2_ = otmp2.apply(lambda x: list(itertools.chain.from_iterable([pop_embed(p, args.t1_size) for p in x])))
     # np.savetxt(f"{dataset}{sparse}_cumembed.txt", otmp2_.values)
-    otmp3 = ototaldft3.pivot(index = 'time4', columns = 'item', values='perc')
+    otmp3 = pd.DataFrame(percs, index=pd.RangeIndex(start, start + percs.shape[0], name='time4'), columns=pd.Index(items, name='item'))
     if args.mode2 == "orig":
         if not args.use_perc:
-            otmp3_ = otmp3.apply(lambda x: list(itertools.chain.from_iterable([pop_embed(p, args.t1_size) for p in x])))
+            otmp3_ = pop_embed_table(otmp3.values, args.t1_size)
         else:
-            otmp3_ = otmp3
-        np.savetxt(f"{dataset}{sparse}_{args.name}embed{args.extra2}.txt", otmp3_.values)
+            otmp3_ = otmp3.values
+        extend_table(f"{dataset}{sparse}_{args.name}embed{args.extra2}.txt", otmp3_, start * otmp3_.shape[0] // len(percs), args.table_format)
     elif args.mode2 == "sin":
-        otmp3_pb = otmp3.apply(lambda x: list(itertools.chain.from_iterable([position_encoding_basis(p) for p in x])))
-        np.savetxt(f"{dataset}{sparse}_{args.name}embed_pos2{args.extra2}.txt", otmp3_pb.values)
+        otmp3_pb = position_encoding_basis_table(otmp3.values, basis_setup)
+        extend_table(f"{dataset}{sparse}_{args.name}embed_pos2{args.extra2}.txt", otmp3_pb, start * len(basis_setup), args.table_format)
     elif args.mode2 == "perc":
-        np.savetxt(f"{dataset}{sparse}_{args.name}perc{args.extra2}.txt", otmp3.values/100)
+        extend_table(f"{dataset}{sparse}_{args.name}perc{args.extra2}.txt", otmp3.values/100, start, args.table_format)
 
     print("saved coarse popularity embeddings")
 
 
 if not args.not_fine:
     # capture previous 4 weeks popularity (if we're at January 30th don't want to lose January 1-January 28 data)
-    ototaldftw = pd.DataFrame(columns=["time6", "item", "perc", "vals"])
-    grouped = ao.groupby('time6')
-    counter = Counter()
-    for i, ints in grouped:
-        if i >= 4:
-            counter.subtract(prev4)
-        counter.update(ints.item)
-        vals = list(counter.values())
-        percs = 100 * rankdata(vals, "average") / len(vals)
-        if args.reverse:
-            percs = 100 - percs
-        percs += np.random.normal(loc=0, scale=args.noise_std, size=percs.shape)
-        percs = np.clip(percs, 0, 100)
-        item_orders = list(counter.keys())
-        left = list(set(items) - set(item_orders))
-        df = pd.DataFrame({"time6": [i for _ in range(len(items))], "item": item_orders + left, "perc": np.concatenate((percs, np.zeros(len(left)))), "vals": np.concatenate((vals, np.zeros(len(left))))})
-        ototaldftw = pd.concat([ototaldftw, df])
-        if i >= 3:
-            prev4 = prev3
-        if i >= 2:
-            prev3 = prev2
-        if i >= 1:
-            prev2 = prev1
-        prev1 = ints.item
+    counts = streamed_counts['time6'] if args.chunksize > 0 else period_counts(ao, 'time6', items)
+    if args.incremental != '':
+        # recompute from the last stored week, the three weeks before it complete its 4-week window
+        start = state['fine_start']
+        prev_counts, prev_seen = widen(state['fine_tail'], len(items)), widen(state['fine_seen'], len(items))
+        counts = counts[start:]
+        counts[0] += widen(state['fine_last'], len(items))
+    else:
+        start, prev_counts, prev_seen = 0, np.zeros((3, len(items))), np.zeros(len(items), dtype=bool)
+    window_counts = np.vstack((prev_counts, counts))
+    vals = rolling_counts(window_counts, 4)[3:]
+    seen = prev_seen | (np.cumsum(counts, axis=0) > 0)
+    state.update(fine_start=start + len(counts) - 1, fine_last=counts[-1], fine_tail=window_counts[-4:-1],
+                 fine_seen=seen[-2] if len(counts) > 1 else prev_seen)
+    percs = percentile_ranks(vals, seen, args.reverse)
+    percs[seen] += np.random.normal(loc=0, scale=args.noise_std, size=seen.sum())
+    percs = np.clip(percs, 0, 100)
     # simple popularity feature w/ lower dimension to reduce time/space
-    oraw = ototaldftw.pivot(index = 'time6', columns = 'item', values='vals')
-    np.savetxt(f"{dataset}{sparse}_week_curr_raw{args.extra2}.txt", oraw.values)
-    otmpw = ototaldftw.pivot(index = 'time6', columns = 'item', values='perc')
+    extend_table(f"{dataset}{sparse}_week_curr_raw{args.extra2}.txt", vals, start, args.table_format)
+    otmpw = pd.DataFrame(percs, index=pd.RangeIndex(start, start + percs.shape[0], name='time6'), columns=pd.Index(items, name='item'))
     if args.mode2 == "orig":
-        otmpw_ = otmpw.apply(lambda x: list(itertools.chain.from_iterable([pop_embed(p, args.t2_size) for p in x])))
-        np.savetxt(f"{dataset}{sparse}_week_embed2{args.extra2}.txt", otmpw_.values)
+        otmpw_ = pop_embed_table(otmpw.values, args.t2_size)
+        extend_table(f"{dataset}{sparse}_week_embed2{args.extra2}.txt", otmpw_, start * (args.t2_size + 1), args.table_format)
     elif args.mode2 == "sin":
-        otmpw_pb = otmpw.apply(lambda x: list(itertools.chain.from_iterable([position_encoding_basis2(p) for p in x])))
-        np.savetxt(f"{dataset}{sparse}_weekembed_pos2{args.extra2}.txt", otmpw_pb.values)
+        otmpw_pb = position_encoding_basis_table(otmpw.values, basis_setup2)
+        extend_table(f"{dataset}{sparse}_weekembed_pos2{args.extra2}.txt", otmpw_pb, start * len(basis_setup2), args.table_format)
     if args.mode2 == "perc":
-        np.savetxt(f"{dataset}{sparse}_week_perc{args.extra2}.txt", otmpw.values/100)
+        extend_table(f"{dataset}{sparse}_week_perc{args.extra2}.txt", otmpw.values/100, start, args.table_format)
     print("saved fine popularity embeddings")
 
+# running state for extending the tables with --incremental
+if args.mode == '':
+    state.update(weight=args.weight, t1_cutoff=args.t1_cutoff, t2_cutoff=args.t2_cutoff, day_shift=args.day_shift, hour_shift=args.hour_shift)
+    with open(state_path, 'wb') as handle:
+        pickle.dump(state, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    print("saved popularity state")
+
 
 # uncomment for user activity features used in regularization loss
 
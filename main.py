@@ -9,6 +9,7 @@ from parse import parse
 from model import SASRec, NewRec, NewB4Rec, BERT4Rec, BPRMF, CL4SRec
 from utils import *
 from data import *
+from model_utils import PopularityFeatures
 from train_test import train_test, train_test_mock
 import pickle
 import psutil
@@ -50,25 +51,46 @@ use_time = ["newrec", "newb4rec", "mostpop"]
 
 # pull data 
 second = False 
+
+# partitioned datasets are memoized on disk across runs unless disabled, and split into user shards if asked
+def partition(func, *params):
+    if args.num_shards > 1:
+        return sharded_partition(func, args.num_shards, *params, cache=not args.no_partition_cache)
+    if args.no_partition_cache:
+        return func(*params)
+    return cached_partition(func, *params)
+
+if args.num_shards > 1:
+    if args.model in ["mostpop", "newb4rec"] or args.dataset2 != "" or args.augment or args.raw_feat_only:
+        raise ValueError("--num_shards supports newrec, sasrec, bert4rec, bprmf and cl4srec on a single dataset without --augment or --raw_feat_only")
+    if args.use_scores or args.save_scores or args.save_ranks:
+        raise ValueError("--num_shards cannot be combined with --use_scores, --save_scores or --save_ranks")
+if args.sampler_pop and args.model != "newrec":
+    raise ValueError("--sampler_pop is newrec only")
+
 # if args.pause:
     # pdb.set_trace()
 if args.model in no_use_time:
-    dataset = data_partition2(args.dataset, args.sparse_name if args.sparse else '', args.override_sparse, args.time_df_mod)
-    [user_train, user_valid, user_test, usernum, itemnum] = dataset
+    dataset = partition(data_partition2, args.dataset, args.sparse_name if args.sparse else '', args.override_sparse, args.time_df_mod)
 elif args.model in no_use_time_track_len:
-    dataset = data_partition3(args.dataset, args.maxlen, args.sparse_name if args.sparse else '', args.override_sparse, args.time_df_mod)
-    [user_train, user_valid, user_test, usernum, itemnum, userlens] = dataset
+    dataset = partition(data_partition3, args.dataset, args.maxlen, args.sparse_name if args.sparse else '', args.override_sparse, args.time_df_mod)
 elif args.model in use_time:
     if args.time_embed:
-        dataset = data_partition_wtime(args.dataset, args.maxlen, args.sparse_name if args.sparse else '', args.override_sparse, args.time_df_mod, args.just_std)
+        dataset = partition(data_partition_wtime, args.dataset, args.maxlen, args.sparse_name if args.sparse else '', args.override_sparse, args.time_df_mod, args.just_std)
     else:
-        dataset = data_partition(args.dataset, args.maxlen, args.sparse_name if args.sparse else '', args.override_sparse, args.time_df_mod)
+        dataset = partition(data_partition, args.dataset, args.maxlen, args.sparse_name if args.sparse else '', args.override_sparse, args.time_df_mod)
+if isinstance(dataset, UserShards):
+    usernum, itemnum = dataset.usernum, dataset.itemnum
+elif args.model in no_use_time_track_len:
+    [user_train, user_valid, user_test, usernum, itemnum, userlens] = dataset
+else:
     [user_train, user_valid, user_test, usernum, itemnum] = dataset
+if args.model in use_time:
     if args.dataset2 != "":
         if args.time_embed:
-            dataset2 = data_partition_wtime(args.dataset2, args.maxlen, args.sparse_name if args.sparse else '', args.override_sparse, args.time_df_mod)
+            dataset2 = partition(data_partition_wtime, args.dataset2, args.maxlen, args.sparse_name if args.sparse else '', args.override_sparse, args.time_df_mod)
         else:
-            dataset2 = data_partition(args.dataset2, args.maxlen, args.sparse_name if args.sparse else '', args.override_sparse, args.time_df_mod)
+            dataset2 = partition(data_partition, args.dataset2, args.maxlen, args.sparse_name if args.sparse else '', args.override_sparse, args.time_df_mod)
         [user_train2, user_valid2, user_test2, usernum2, itemnum2] = dataset2
         second = True
 
@@ -90,10 +112,15 @@ if second:
 
 print(f"done loading data for {args.dataset}!")
 
-if args.model == "newrec":
+if isinstance(dataset, UserShards):
+    num_batch = (int(dataset.interactions().sum()) if args.model == "bprmf" else usernum) // args.batch_size
+elif args.model == "newrec":
     num_batch = len(user_train[0]) // args.batch_size
     if second:
         num_batch2 = len(user_train2[0]) // args.batch_size
+elif args.model == "bprmf":
+    # batches are single interactions, an epoch covers as many as the training set holds
+    num_batch = int(user_train.lengths().sum()) // args.batch_size
 else:
     num_batch = len(user_train) // args.batch_size
 
@@ -108,16 +135,20 @@ sampler = None
 sampler2 = None
 if not args.inference_only:
     # positive (and negative if applicable) sampling for training
-    if args.raw_feat_only:
-        misc = np.loadtxt(f"../data/{args.dataset}_{args.userpop}.txt")[1:40000].astype(np.int32)
-        user_comb = (user_train, user_valid, user_test)
-    elif args.model in ["cl4srec", "duorec"]:
-        misc = userlens
-        user_comb = user_train
+    features = PopularityFeatures(args) if args.sampler_pop else None
+    if isinstance(dataset, UserShards):
+        sampler = ShardedSampler(dataset, args.model, batch_size=args.batch_size, maxlen=args.maxlen, n_workers=4, mask_prob=args.mask_prob, features=features)
     else:
-        misc = None
-        user_comb = user_train
-    sampler = WarpSampler(user_comb, usernum, itemnum, args.model, batch_size=args.batch_size, maxlen=args.maxlen,n_workers=4, mask_prob=args.mask_prob, augment=args.augment, raw_feature_only=args.raw_feat_only, misc=misc)
+        if args.raw_feat_only:
+            misc = np.loadtxt(f"../data/{args.dataset}_{args.userpop}.txt")[1:usernum + 1].astype(np.int32)
+            user_comb = (user_train, user_valid, user_test)
+        elif args.model in ["cl4srec", "duorec"]:
+            misc = userlens
+            user_comb = user_train
+        else:
+            misc = None
+            user_comb = user_train
+        sampler = WarpSampler(user_comb, usernum, itemnum, args.model, batch_size=args.batch_size, maxlen=args.maxlen,n_workers=4, mask_prob=args.mask_prob, augment=args.augment, raw_feature_only=args.raw_feat_only, misc=misc, features=features)
     if second:
         sampler2 = WarpSampler(user_train2, usernum2, itemnum2, args.model, batch_size=args.batch_size, maxlen=args.maxlen, n_workers=int(os.cpu_count()/2), mask_prob=args.mask_prob, augment=args.augment)
 print(f"done training sampler for {args.dataset}!")
@@ -129,9 +129,13 @@ class NewRec(torch.nn.Module):
             new_fwd_layer = PointWiseFeedForward(self.hidden_units, args.dropout_rate)
             self.forward_layers.append(new_fwd_layer)
 
-    def log2feats(self, users, log_seqs, time1_seqs, time2_seqs, time_embed):
-        # obtain popularity-based feature vectors for sequence history, apply embedding layer, add positional encoding
-        seqs = self.popularity_enc(log_seqs, time1_seqs, time2_seqs)
+    def log2feats(self, users, log_seqs, time1_seqs, time2_seqs, time_embed, pop_feats=None):
+        # obtain popularity-based feature vectors for sequence history (unless already gathered by the sampler),
+        # apply embedding layer, add positional encoding
+        if pop_feats is None:
+            seqs = self.popularity_enc(log_seqs, time1_seqs, time2_seqs)
+        else:
+            seqs = torch.as_tensor(pop_feats, device=self.dev)
         seqs = self.embed_layer(seqs)
         if self.fs_emb:
             seqs = self.fs_layer(seqs) 
@@ -226,12 +230,16 @@ class NewRec(torch.nn.Module):
         neg_seqs,
         pos_user,
         neg_user,
+        pop_feats=None,
     ):  
         # for training
+        # pop_feats are the (history, pos, neg) popularity features from a sampler with PopularityFeatures, if any
         # avoid information leakage with lag >= 1
         time1_seqs, time2_seqs = np.maximum(0, time1_seqs - 1 - self.lag//4), np.maximum(0, time2_seqs - self.lag)
+        if pop_feats is None:
+            pop_feats = (None, None, None)
         # obtain user feature at each position
-        log_feats = self.log2feats(users, log_seqs, time1_seqs[:,:-1], time2_seqs[:,:-1], time_embed)
+        log_feats = self.log2feats(users, log_seqs, time1_seqs[:,:-1], time2_seqs[:,:-1], time_embed, pop_feats[0])
         if self.traj_form == 'mlp':
             user_feats = self.user2feats(users, time1_seqs[:,:-1])
             full_feats = 0.5 * log_feats + 0.5 * user_feats
@@ -247,12 +255,16 @@ class NewRec(torch.nn.Module):
         else:
             mod_time1, mod_time2 = time1_seqs[:,1:], time1_seqs[:,1:]
         # obtain popularity-based embeddings for positive and negative item sequences
-        pos_embs = self.embed_layer(
-            self.popularity_enc(pos_seqs, mod_time1, mod_time2)
-        )
-        neg_embs = self.embed_layer(
-            self.popularity_enc(neg_seqs, mod_time1, mod_time2)
-        )
+        if pop_feats[1] is None:
+            pos_embs = self.embed_layer(
+                self.popularity_enc(pos_seqs, mod_time1, mod_time2)
+            )
+            neg_embs = self.embed_layer(
+                self.popularity_enc(neg_seqs, mod_time1, mod_time2)
+            )
+        else:
+            pos_embs = self.embed_layer(torch.as_tensor(pop_feats[1], device=self.dev))
+            neg_embs = self.embed_layer(torch.as_tensor(pop_feats[2], device=self.dev))
 
         # combine embeddings with item cooccurrence based features 
         if self.itemgrp:
@@ -531,6 +543,9 @@ class BPRMF(torch.nn.Module):
         item_i = self.item_emb(torch.LongTensor(pos_item).to(self.dev))
         item_j = self.item_emb(torch.LongTensor(neg_item).to(self.dev))
 
+        # one (pos, neg) pair per user, or a padded row of them
+        if item_i.dim() == 2:
+            return (item_i * user).sum(dim=-1), (item_j * user).sum(dim=-1)
         prediction_i = item_i.matmul(user.unsqueeze(-1)).squeeze(-1)
         prediction_j = item_j.matmul(user.unsqueeze(-1)).squeeze(-1)
         return prediction_i, prediction_j
@@ -741,6 +756,9 @@ class CL4SRec(torch.nn.Module):
         self.n_items = item_num
         self.dev = args.device
         self.batch_size = args.batch_size
+        # augmentation randomness is drawn on the device from its own seeded generator
+        self.aug_generator = torch.Generator(device=self.dev)
+        self.aug_generator.manual_seed(args.seed)
 
         self.mask_default = self.mask_correlated_samples(batch_size=self.batch_size)
         self.item_emb = torch.nn.Embedding(
@@ -808,53 +826,58 @@ class CL4SRec(torch.nn.Module):
 
         return log_feats
 
+    # the augmentations work on a whole (batch, maxlen) tensor of right-aligned sequences with lengths item_seq_len
+    def rand(self, *shape):
+        return torch.rand(shape, generator=self.aug_generator, device=self.dev)
+
     def item_crop(self, item_seq, item_seq_len, eta=0.6):
-        num_left = math.floor(item_seq_len * eta)
-        if item_seq_len.cpu() - num_left <= 1:
-            return item_seq
-        crop_begin = random.randint(1, item_seq_len.cpu() - num_left)
-        croped_item_seq = np.zeros(item_seq.shape)
-        croped_item_seq[-num_left:] = item_seq.cpu().detach().numpy()[-num_left - crop_begin:-crop_begin]
-        return torch.tensor(croped_item_seq, dtype=torch.long, device=item_seq.device)
+        # keep a random window of floor(len * eta) items ending 1..len - num_left before the last one, right-aligned
+        num_left = torch.floor(item_seq_len * eta).long()
+        crop_begin = (self.rand(len(item_seq)) * (item_seq_len - num_left)).long() + 1
+        cols = torch.arange(item_seq.shape[1], device=item_seq.device)
+        croped_item_seq = item_seq.gather(1, (cols - crop_begin.unsqueeze(1)).clamp(min=0))
+        croped_item_seq = croped_item_seq * (cols >= item_seq.shape[1] - num_left.unsqueeze(1))
+        return torch.where((item_seq_len - num_left <= 1).unsqueeze(1), item_seq, croped_item_seq)
 
     def item_mask(self, item_seq, item_seq_len, gamma=0.3):
-        num_mask = math.floor(item_seq_len * gamma)
-        mask_index = np.random.randint(1, item_seq_len.cpu()+1, num_mask)
-        # mask_index = random.sample(range(1, item_seq_len+1), k=num_mask)
-        masked_item_seq = item_seq.cpu().detach().numpy().copy()
-        masked_item_seq[-mask_index] = 0 # token 0 has been used for semantic masking
-        return torch.tensor(masked_item_seq, dtype=torch.long, device=item_seq.device)
+        # set floor(len * gamma) positions drawn with replacement among the last len to 0
+        num_mask = torch.floor(item_seq_len * gamma).long()
+        width = max(int(num_mask.max()), 1) if len(item_seq) > 0 else 1
+        mask_index = (self.rand(len(item_seq), width) * item_seq_len.unsqueeze(1)).long() + 1
+        mask_index = torch.where(torch.arange(width, device=item_seq.device) < num_mask.unsqueeze(1), mask_index, 0)
+        masked = torch.zeros(item_seq.shape, dtype=torch.bool, device=item_seq.device)
+        # unused draws point one past the end and are dropped
+        masked = torch.cat((masked, masked[:, :1]), 1).scatter_(1, item_seq.shape[1] - mask_index, True)[:, :-1]
+        return item_seq * ~masked # token 0 has been used for semantic masking
 
     def item_reorder(self, item_seq, item_seq_len, beta=0.6):
-        num_reorder = math.floor(item_seq_len * beta)
-        if item_seq_len.cpu() - num_reorder <= 1:
-            return item_seq
-        reorder_begin = np.random.randint(1, item_seq_len.cpu() - num_reorder)
-        reordered_item_seq = item_seq.cpu().detach().numpy().copy()
-        shuffle_index = np.arange(-reorder_begin - num_reorder, -reorder_begin)
-        np.random.shuffle(shuffle_index)
-        reordered_item_seq[shuffle_index] = reordered_item_seq[-reorder_begin - num_reorder:-reorder_begin]
-        return torch.tensor(reordered_item_seq, dtype=torch.long, device=item_seq.device)
+        # shuffle a random segment of floor(len * beta) items ending 1..len - num_reorder - 1 before the last one
+        num_reorder = torch.floor(item_seq_len * beta).long()
+        reorder_begin = (self.rand(len(item_seq)) * (item_seq_len - num_reorder - 1)).long() + 1
+        seg_end = item_seq.shape[1] - reorder_begin
+        seg_start = seg_end - num_reorder
+        cols = torch.arange(item_seq.shape[1], device=item_seq.device)
+        in_seg = (cols >= seg_start.unsqueeze(1)) & (cols < seg_end.unsqueeze(1))
+        # positions outside the segment sort to themselves, inside it to a random order within the segment
+        keys = torch.where(
+            in_seg, seg_start.unsqueeze(1) - 0.5 + self.rand(*item_seq.shape) * num_reorder.unsqueeze(1), cols.float()
+        )
+        reordered_item_seq = item_seq.gather(1, keys.argsort(1))
+        return torch.where((item_seq_len - num_reorder <= 1).unsqueeze(1), item_seq, reordered_item_seq)
 
     def augment(self, log_seq_np, log_seq_len):
+        # two different augmentations per sequence, chosen like random.sample(range(3), k=2)
         log_seq = torch.LongTensor(log_seq_np).to(self.dev)
-        aug_seq1 = torch.clone(log_seq)
-        aug_seq2 = torch.clone(log_seq)
-        for i in range(log_seq.shape[0]):
-            switch = random.sample(range(3), k=2)
-            if switch[0] == 0:
-                aug_seq1[i]= self.item_crop(log_seq[i], log_seq_len[i])
-            elif switch[0] == 1:
-                aug_seq1[i] = self.item_mask(log_seq[i], log_seq_len[i])
-            elif switch[0] == 2:
-                aug_seq1[i] = self.item_reorder(log_seq[i], log_seq_len[i])
-            if switch[1] == 0:
-                aug_seq2[i] = self.item_crop(log_seq[i], log_seq_len[i])
-            elif switch[1] == 1:
-                aug_seq2[i] = self.item_mask(log_seq[i], log_seq_len[i])
-            elif switch[1] == 2:
-                aug_seq2[i] = self.item_reorder(log_seq[i], log_seq_len[i])
-        return aug_seq1, aug_seq2
+        log_seq_len = torch.as_tensor(log_seq_len, device=self.dev)
+        switch = self.rand(len(log_seq), 3).argsort(1)[:, :2]
+        # both views stacked, each operator only runs on the rows that chose it
+        choice = torch.cat((switch[:, 0], switch[:, 1]))
+        seqs, seq_lens = log_seq.repeat(2, 1), log_seq_len.repeat(2)
+        augs = torch.empty_like(seqs)
+        for k, aug in enumerate([self.item_crop, self.item_mask, self.item_reorder]):
+            rows = torch.nonzero(choice == k).squeeze(1)
+            augs.index_copy_(0, rows, aug(seqs[rows], seq_lens[rows]))
+        return augs[:len(log_seq)], augs[len(log_seq):]
 
     def mask_correlated_samples(self, batch_size):
         N = 2 * batch_size
@@ -3,6 +3,173 @@ import numpy as np
 import torch
 import pdb
 import copy
+import weakref
+from tables import load_table
+
+
+# fixed-point scale of compact percentile tables, 0 is kept for items without popularity in a period
+PERC_SCALE = 32767 / 100
+
+
+def compact_table(pop, base_dim, pad_periods):
+    """
+    one 16-bit percentile per (period, item) of a soft one-hot popularity table of shape (num_times*base_dim, num_items)
+    with zeros added for the index-0 empty item placeholder and pad_periods initial time periods
+    """
+    if pop.shape[0] % base_dim != 0:
+        raise ValueError("popularity table rows are not a multiple of base_dim")
+    weights = np.asarray(pop, dtype=np.float32).reshape((-1, base_dim, pop.shape[1]))
+    sums = weights.sum(axis=1)
+    if not np.all(np.isclose(sums, 0, atol=1e-4) | np.isclose(sums, 1, atol=1e-4)):
+        raise ValueError("compact popularity tables need soft one-hot (pop_embed) tables")
+    # the two interpolation weights of a percentile are its position between neighbouring bins
+    perc = (100 // (base_dim - 1)) * np.tensordot(np.arange(base_dim, dtype=np.float32), weights, axes=(0, 1))
+    compact = np.zeros((perc.shape[0] + pad_periods, perc.shape[1] + 1), dtype=np.int16)
+    compact[pad_periods:, 1:] = np.where(perc > 0, np.maximum(np.rint(perc * PERC_SCALE), 1), 0)
+    return torch.from_numpy(compact)
+
+
+def window_table(pop, base_dim, pad_periods):
+    """
+    (num_times, num_items, base_dim) layout of a popularity table of shape (num_times*base_dim, num_items)
+    with zeros added for the index-0 empty item placeholder and pad_periods initial time periods
+    """
+    if pop.shape[0] % base_dim != 0:
+        raise ValueError("popularity table rows are not a multiple of base_dim")
+    table = np.zeros((pop.shape[0] // base_dim + pad_periods, pop.shape[1] + 1, base_dim), dtype=np.float32)
+    table[pad_periods:, 1:] = np.asarray(pop, dtype=np.float32).reshape((-1, base_dim, pop.shape[1])).transpose((0, 2, 1))
+    return torch.from_numpy(table)
+
+
+def gather_window(table, log_seqs, time_seqs, input_units, base_dim, check=False):
+    """
+    popularity of each item over the input_units // base_dim periods ending at its time, shape: (batch, seq, input_units)
+    one index_select of (period, item) positions on the table's device, from a window_table or a compact_table
+    """
+    num_periods = input_units // base_dim
+    times = torch.as_tensor(time_seqs, dtype=torch.long, device=table.device).reshape((-1, 1))
+    items = torch.as_tensor(log_seqs, dtype=torch.long, device=table.device).reshape((-1, 1))
+    # opt-in since it syncs with the device
+    if check and items.numel() > 0 and (
+        times.min() < 0 or times.max() + num_periods > table.shape[0] or items.min() < 0 or items.max() >= table.shape[1]
+    ):
+        raise IndexError("row or column accessed out-of-index in popularity table")
+    index = ((times + torch.arange(num_periods, device=table.device)) * table.shape[1] + items).flatten()
+    if table.dim() == 3:
+        pop = table.reshape((-1, base_dim)).index_select(0, index)
+    else:
+        perc = table.flatten().index_select(0, index).float().unsqueeze(-1) / PERC_SCALE
+        # pop_embed: weight 1 - distance to each bin, for the at most two bins within distance 1
+        rev = 100 // (base_dim - 1)
+        pop = torch.clamp(1 - torch.abs(perc - torch.arange(base_dim, device=table.device) * rev) / rev, min=0) * (perc > 0)
+    return pop.reshape((log_seqs.shape[0], log_seqs.shape[1], input_units))
+
+
+def gather_rows(table, log_seqs, time_seqs, input_units, base_dim):
+    """
+    numpy counterpart of gather_window reading a popularity table as saved, shape (num_times*base_dim, num_items),
+    so a read-only memmap can be gathered from directly, shape: (batch, seq, input_units)
+    """
+    num_periods = input_units // base_dim
+    items = np.asarray(log_seqs, dtype=np.int64)[..., None, None]
+    # period of each window slot, the window ends at the item's time like the padded window_table
+    periods = np.asarray(time_seqs, dtype=np.int64)[..., None, None] + np.arange(num_periods)[:, None] - (num_periods - 1)
+    valid = (periods >= 0) & (items > 0)
+    rows = np.where(valid, periods, 0) * base_dim + np.arange(base_dim)
+    pop = np.where(valid, table[rows, np.where(valid, items - 1, 0)], 0).astype(np.float32)
+    return pop.reshape(pop.shape[:2] + (input_units,))
+
+
+class PopularityFeatures(object):
+    """
+    NewRec's training popularity features (history, pos, neg) computed outside the model, for sampler workers
+    reads the month and week tables as read-only memmaps (see load_table), opened on first use so pickling stays cheap
+    """
+    def __init__(self, args, second=False):
+        dataset = args.dataset2 if second else args.dataset
+        self.paths = (f"../data/{dataset}_{args.monthpop}.txt", f"../data/{dataset}_{args.weekpop}.txt")
+        self.input1 = args.input_units1
+        self.input2 = args.input_units2
+        self.base_dim1 = args.base_dim1
+        self.base_dim2 = args.base_dim2
+        self.lag = args.lag
+        self.prev_time = args.prev_time
+        self.tables = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["tables"] = None
+        return state
+
+    def encode(self, log_seqs, time1_seqs, time2_seqs):
+        if self.tables is None:
+            self.tables = tuple(load_table(path) for path in self.paths)
+        month_pop = gather_rows(self.tables[0], log_seqs, time1_seqs, self.input1, self.base_dim1)
+        week_pop = gather_rows(self.tables[1], log_seqs, time2_seqs, self.input2, self.base_dim2)
+        return np.concatenate((month_pop, week_pop), 2)
+
+    def __call__(self, seq, time1, time2, pos, neg):
+        # same lag and time choices as NewRec.forward
+        time1, time2 = np.maximum(0, time1 - 1 - self.lag // 4), np.maximum(0, time2 - self.lag)
+        if self.prev_time:
+            mod_time1, mod_time2 = time1[:, :-1], time2[:, :-1]
+        else:
+            mod_time1, mod_time2 = time1[:, 1:], time1[:, 1:]
+        return (
+            self.encode(seq, time1[:, :-1], time2[:, :-1]),
+            self.encode(pos, mod_time1, mod_time2),
+            self.encode(neg, mod_time1, mod_time2),
+        )
+
+
+# popularity tables shared by every encoder in the process, keyed by (dataset, table name, layout) and device
+# entries only live while some module still holds them, so the host copy is freed once every module moved to a device
+popularity_tables = weakref.WeakValueDictionary()
+
+
+def shared_table(dataset, name, layout="rows", base_dim=1, pad_periods=0, device="cpu"):
+    """
+    popularity table loaded once per process and laid out once per device, every caller gets the same tensor
+    layout is window (window_table), compact (compact_table) or rows (the table as saved), tables are never written to
+    """
+    key = (dataset, name, layout, base_dim, pad_periods)
+    device = str(torch.device(device))
+    table = popularity_tables.get((key, device))
+    if table is None:
+        table = popularity_tables.get((key, "cpu"))
+        if table is None:
+            saved = load_table(f"../data/{dataset}_{name}.txt")
+            if layout == "window":
+                table = window_table(saved, base_dim, pad_periods)
+            elif layout == "compact":
+                table = compact_table(saved, base_dim, pad_periods)
+            else:
+                table = torch.tensor(saved, dtype=torch.float32)
+            popularity_tables[key, "cpu"] = table
+        table = table.to(device)
+        popularity_tables[key, device] = table
+    return table
+
+
+class SharedTableModule(torch.nn.Module):
+    """
+    module holding popularity tables from shared_table instead of its own buffers, moving it to a device
+    picks up the shared copy there (tables are not part of the state dict)
+    """
+    def __init__(self):
+        super(SharedTableModule, self).__init__()
+        self.table_specs = {}
+
+    def add_table(self, attr, *spec):
+        self.table_specs[attr] = spec
+        setattr(self, attr, shared_table(*spec))
+
+    def _apply(self, fn, *args, **kwargs):
+        module = super(SharedTableModule, self)._apply(fn, *args, **kwargs)
+        device = fn(torch.zeros(0)).device
+        for attr, spec in self.table_specs.items():
+            setattr(self, attr, shared_table(*spec, device=device))
+        return module
 
 
 # taken from https://github.com/pmixer/SASRec.pytorch/blob/master/model.py
@@ -316,8 +483,8 @@ class UserActivityEncoding(torch.nn.Module):
 
 
 
-class PopularityEncoding(torch.nn.Module):
-    def __init__(self, args, second):
+class PopularityEncoding(SharedTableModule):
+    def __init__(self, args, second=False):
         super(PopularityEncoding, self).__init__()
         n_position = args.maxlen
         d_hid = args.hidden_units
@@ -325,89 +492,25 @@ class PopularityEncoding(torch.nn.Module):
         self.input2 = args.input_units2
         self.base_dim1 = args.base_dim1
         self.base_dim2 = args.base_dim2
+        self.compact = args.compact_pop
+        self.check_index = args.check_pop_index
+        if self.input1 % self.base_dim1 != 0 or self.input2 % self.base_dim2 != 0:
+            raise ValueError("input_units1/input_units2 must be multiples of base_dim1/base_dim2")
+        dataset = args.dataset2 if second else args.dataset
         # table of fixed feature vectors for items by time, shape: (num_times*base_dim, num_items)
-        if not second:
-            month_pop = np.loadtxt(f"../data/{args.dataset}_{args.monthpop}.txt")
-            week_pop = np.loadtxt(f"../data/{args.dataset}_{args.weekpop}.txt")
-        else:
-            month_pop = np.loadtxt(f"../data/{args.dataset2}_{args.monthpop}.txt")
-            week_pop = np.loadtxt(f"../data/{args.dataset2}_{args.weekpop}.txt")
-        # add zeros for the index-0 empty item placeholder and initial time period
-        self.register_buffer(
-            "month_pop_table",
-            torch.cat(
-                (
-                    torch.zeros((month_pop.shape[0] + self.input1 - self.base_dim1, 1)),
-                    torch.cat(
-                        (
-                            torch.zeros(
-                                (self.input1 - self.base_dim1, month_pop.shape[1])
-                            ),
-                            torch.FloatTensor(month_pop),
-                        ),
-                        dim=0,
-                    ),
-                ),
-                dim=1,
-            ),
-        )
-        self.register_buffer(
-            "week_pop_table",
-            torch.cat(
-                (
-                    torch.zeros((week_pop.shape[0] + self.input2 - self.base_dim2, 1)),
-                    torch.cat(
-                        (
-                            torch.zeros(
-                                (self.input2 - self.base_dim2, week_pop.shape[1])
-                            ),
-                            torch.FloatTensor(week_pop),
-                        ),
-                        dim=0,
-                    ),
-                ),
-                dim=1,
-            ),
-        )
+        # kept as (num_times, num_items, base_dim) or compact (num_times, num_items) so a window of periods is one gather,
+        # with zeros for the index-0 empty item placeholder and the periods before the first one
+        layout = "compact" if self.compact else "window"
+        self.add_table("month_pop_table", dataset, args.monthpop, layout, self.base_dim1, self.input1 // self.base_dim1 - 1)
+        self.add_table("week_pop_table", dataset, args.weekpop, layout, self.base_dim2, self.input2 // self.base_dim2 - 1)
 
     def forward(self, log_seqs, time1_seqs, time2_seqs):
-        month_table_rows = torch.flatten(
-            torch.flatten(torch.LongTensor(time1_seqs)).reshape((-1, 1))
-            * self.base_dim1
-            + torch.arange(self.input1)
-        )
-        month_table_cols = torch.repeat_interleave(
-            torch.flatten(torch.LongTensor(log_seqs)), self.input1
-        )
-        week_table_rows = torch.flatten(
-            torch.flatten(torch.LongTensor(time2_seqs)).reshape((-1, 1))
-            * self.base_dim2
-            + torch.arange(self.input2)
-        )
-        week_table_cols = torch.repeat_interleave(
-            torch.flatten(torch.LongTensor(log_seqs)), self.input2
-        )
-        if (
-                (month_table_rows.numel() > 0 and torch.max(month_table_rows) >= self.month_pop_table.shape[0]) or
-                (month_table_cols.numel() > 0 and torch.max(month_table_cols) >= self.month_pop_table.shape[1]) or
-                (week_table_rows.numel() > 0 and torch.max(week_table_rows) >= self.week_pop_table.shape[0]) or
-                (week_table_cols.numel() > 0 and torch.max(week_table_cols) >= self.week_pop_table.shape[1])
-        ):
-            # week_table_rows[week_table_rows >= self.week_pop_table.shape[0]]
-            pdb.set_trace()
-            # raise IndexError("row or column accessed out-of-index in popularity table")
-        month_pop = torch.reshape(
-            self.month_pop_table[month_table_rows, month_table_cols],
-            (log_seqs.shape[0], log_seqs.shape[1], self.input1),
-        )
-        week_pop = torch.reshape(
-            self.week_pop_table[week_table_rows, week_table_cols],
-            (log_seqs.shape[0], log_seqs.shape[1], self.input2),
-        )
-        return torch.cat((month_pop, week_pop), 2).clone().detach()
+        month_pop = gather_window(self.month_pop_table, log_seqs, time1_seqs, self.input1, self.base_dim1, self.check_index)
+        week_pop = gather_window(self.week_pop_table, log_seqs, time2_seqs, self.input2, self.base_dim2, self.check_index)
+        return torch.cat((month_pop, week_pop), 2)
 
 
-class EvalPopularityEncoding(torch.nn.Module):
+class EvalPopularityEncoding(SharedTableModule):
     def __init__(self, args):
         super(EvalPopularityEncoding, self).__init__()
         n_position = args.maxlen
@@ -417,87 +520,25 @@ class EvalPopularityEncoding(torch.nn.Module):
         self.base_dim1 = args.base_dim1
         self.base_dim2 = args.base_dim2
         self.pause = args.pause
+        self.compact = args.compact_pop
+        self.check_index = args.check_pop_index
+        if self.input1 % self.base_dim1 != 0 or self.input2 % self.base_dim2 != 0:
+            raise ValueError("input_units1/input_units2 must be multiples of base_dim1/base_dim2")
         # table of fixed feature vectors for items by time, shape: (num_times*base_dim, num_items)
-        month_pop = np.loadtxt(f"../data/{args.dataset}_{args.monthpop}.txt")
-        week_pop = np.loadtxt(f"../data/{args.dataset}_{args.weekpop}.txt")
-        week_eval_pop = np.loadtxt(f"../data/{args.dataset}_{args.week_eval_pop}.txt")
-        self.register_buffer("week_eval_pop", torch.FloatTensor(week_eval_pop))
-        # add zeros for the index-0 empty item placeholder and initial time period
-        self.register_buffer(
-            "month_pop_table",
-            torch.cat(
-                (
-                    torch.zeros((month_pop.shape[0] + self.input1 - self.base_dim1, 1)),
-                    torch.cat(
-                        (
-                            torch.zeros(
-                                (self.input1 - self.base_dim1, month_pop.shape[1])
-                            ),
-                            torch.FloatTensor(month_pop),
-                        ),
-                        dim=0,
-                    ),
-                ),
-                dim=1,
-            ),
-        )
-        self.register_buffer(
-            "week_pop_table",
-            torch.cat(
-                (
-                    torch.zeros((week_pop.shape[0] + self.input2 - self.base_dim2, 1)),
-                    torch.cat(
-                        (
-                            torch.zeros(
-                                (self.input2 - self.base_dim2, week_pop.shape[1])
-                            ),
-                            torch.FloatTensor(week_pop),
-                        ),
-                        dim=0,
-                    ),
-                ),
-                dim=1,
-            ),
-        )
+        # same tables as PopularityEncoding, so both share one copy
+        layout = "compact" if self.compact else "window"
+        self.add_table("week_eval_pop", args.dataset, args.week_eval_pop)
+        self.add_table("month_pop_table", args.dataset, args.monthpop, layout, self.base_dim1, self.input1 // self.base_dim1 - 1)
+        self.add_table("week_pop_table", args.dataset, args.weekpop, layout, self.base_dim2, self.input2 // self.base_dim2 - 1)
 
     def forward(self, log_seqs, time1_seqs, time2_seqs, user):
-        month_table_rows = torch.flatten(
-            torch.flatten(torch.LongTensor(time1_seqs)).reshape((-1, 1))
-            * self.base_dim1
-            + torch.arange(self.input1)
-        )
-        month_table_cols = torch.repeat_interleave(
-            torch.flatten(torch.LongTensor(log_seqs)), self.input1
-        )
+        month_pop = gather_window(self.month_pop_table, log_seqs, time1_seqs, self.input1, self.base_dim1, self.check_index)
+        # recent week popularity comes from the adjusted evaluation table instead, base_dim2 rows per user
+        user_rows = (torch.as_tensor(user, dtype=torch.long, device=self.week_eval_pop.device).reshape((-1, 1)) - 1) * self.base_dim2
+        week_eval_rows = (user_rows + torch.arange(self.base_dim2, device=self.week_eval_pop.device)).flatten()
+        recent_pop = torch.swapaxes(self.week_eval_pop.index_select(0, week_eval_rows).reshape((len(user), self.base_dim2, -1)), 1, 2)
         if self.input2 > self.base_dim2:
-            week_table_rows = torch.flatten(
-                torch.flatten(torch.LongTensor(time2_seqs)).reshape((-1, 1))
-                * self.base_dim2
-                + torch.arange(self.input2 - self.base_dim2)
-            )
-            week_table_cols = torch.repeat_interleave(
-                torch.flatten(torch.LongTensor(log_seqs)), self.input2 - self.base_dim2
-            )
-            if (torch.max(week_table_rows) >= self.week_pop_table.shape[0] or torch.max(week_table_cols) >= self.week_pop_table.shape[1]):
-                raise IndexError("row or column accessed out-of-index in popularity table")
-
-        if (
-            torch.max(month_table_rows) >= self.month_pop_table.shape[0]
-            or torch.max(month_table_cols) >= self.month_pop_table.shape[1]
-        ):
-            raise IndexError("row or column accessed out-of-index in popularity table")
-        month_pop = torch.reshape(
-            self.month_pop_table[month_table_rows, month_table_cols],
-            (log_seqs.shape[0], log_seqs.shape[1], self.input1),
-        )
-
-        week_eval_rows = torch.flatten((torch.LongTensor(user-1)*self.base_dim2).unsqueeze(1) + torch.arange(self.base_dim2))
-        recent_pop = torch.swapaxes(self.week_eval_pop[week_eval_rows].reshape((len(user), 6, -1)), 1, 2)
-        if self.input2 > self.base_dim2:
-            week_pop = torch.reshape(
-                self.week_pop_table[week_table_rows, week_table_cols],
-                (log_seqs.shape[0], log_seqs.shape[1], self.input2 - self.base_dim2),
-            )
-            return torch.cat((month_pop, week_pop, recent_pop), 2).clone().detach()
+            week_pop = gather_window(self.week_pop_table, log_seqs, time2_seqs, self.input2 - self.base_dim2, self.base_dim2, self.check_index)
+            return torch.cat((month_pop, week_pop, recent_pop), 2)
         else:
-            return torch.cat((month_pop, recent_pop), 2).clone().detach()
\ No newline at end of file
+            return torch.cat((month_pop, recent_pop), 2)
@@ -38,6 +38,11 @@ def parse():
     parser.add_argument('--input_units1', default=132, type=int, help='base_dim1 * number of months considered, newrec only')
     parser.add_argument('--base_dim2', default=6, type=int, help='dimension of week popularity vector, newrec only')
     parser.add_argument('--input_units2', default=6, type=int, help='base_dim2 * number of 4 week groups considered, newrec only')
+    parser.add_argument('--compact_pop', action='store_true', help='keep one 16-bit percentile per period and item on device and expand it to the base_dim vectors when gathering, newrec only')
+    parser.add_argument('--no_partition_cache', action='store_true', help='always rebuild the train/valid/test partition instead of loading it from ../data/*partition*/')
+    parser.add_argument('--num_shards', default=1, type=int, help='split users into this many id ranges and partition, train and evaluate one range at a time to bound memory')
+    parser.add_argument('--check_pop_index', action='store_true', help='validate popularity table indices on every gather (syncs with the device), newrec only')
+    parser.add_argument('--sampler_pop', action='store_true', help='gather training popularity features from memory-mapped tables in the sampler workers instead of the trainer, newrec only')
     parser.add_argument('--mask_prob', default=0, type=float, help='cloze task, bert4rec only')
     parser.add_argument('--seed', default=2023, type=int)
     parser.add_argument('--topk','--list', nargs='+', default=[10, 5, 1], type=int, help='# items for evaluation')
@@ -0,0 +1,29 @@
+import os
+import numpy as np
+
+
+def save_table(path, arr, table_format="both"):
+    """
+    write a popularity table as text and/or as a float32 .npy next to it, which load_table memory-maps
+    """
+    npy_path = os.path.splitext(path)[0] + ".npy"
+    if table_format in ["txt", "both"]:
+        np.savetxt(path, arr)
+    if table_format in ["npy", "both"]:
+        np.save(npy_path, np.asarray(arr, dtype=np.float32))
+    elif os.path.exists(npy_path):
+        # loaders prefer the .npy copy, so don't leave a stale one behind
+        os.remove(npy_path)
+
+
+def load_table(path):
+    """
+    load a popularity table written by save_table
+    memory-maps the float32 .npy copy next to the .txt path when present, otherwise parses the text file
+    both are at least 2-D, so a one-row table has the same shape whichever copy is read
+    """
+    npy_path = os.path.splitext(path)[0] + ".npy"
+    if os.path.exists(npy_path):
+        table = np.load(npy_path, mmap_mode="r")
+        return table if table.ndim >= 2 else table[None]
+    return np.loadtxt(path, ndmin=2)
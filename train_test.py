@@ -43,10 +43,10 @@ def train_test(args, sampler, num_batch, model, dataset, epoch_start_idx, write,
                 # get batch data
                 u, seq, pos, neg = sampler.next_batch()
                 u, seq, pos, neg = (
-                    np.array(u),
-                    np.array(seq),
-                    np.array(pos),
-                    np.array(neg),
+                    np.asarray(u),
+                    np.asarray(seq),
+                    np.asarray(pos),
+                    np.asarray(neg),
                 )
                 # model output
                 pos_logits, neg_logits = model(seq, pos, neg)
@@ -84,14 +84,18 @@ def train_test(args, sampler, num_batch, model, dataset, epoch_start_idx, write,
         elif args.model == "newrec":
             bce_criterion = torch.nn.BCEWithLogitsLoss()
             for step in range(int(num_batch*args.fs_prop)):
-                # batch data based on if relative time encodings are used
+                # batch data based on if relative time encodings are used, popularity features last with --sampler_pop
+                batch = sampler.next_batch()
+                pop_feats = None
+                if args.sampler_pop:
+                    batch, pop_feats = batch[:-3], batch[-3:]
                 if not args.time_embed:
-                    u, seq, time1, time2, pos, neg = sampler.next_batch()
-                    u, seq, time1, time2, pos, neg = (np.array(u), np.array(seq), np.array(time1), np.array(time2), np.array(pos), np.array(neg))
+                    u, seq, time1, time2, pos, neg = batch
+                    u, seq, time1, time2, pos, neg = (np.asarray(u), np.asarray(seq), np.asarray(time1), np.asarray(time2), np.asarray(pos), np.asarray(neg))
                     time_embed = None
                 else:
-                    u, seq, time1, time2, time_embed, pos, neg = sampler.next_batch()
-                    u, seq, time1, time2, time_embed, pos, neg = (np.array(u), np.array(seq), np.array(time1), np.array(time2), np.array(time_embed), np.array(pos), np.array(neg))
+                    u, seq, time1, time2, time_embed, pos, neg = batch
+                    u, seq, time1, time2, time_embed, pos, neg = (np.asarray(u), np.asarray(seq), np.asarray(time1), np.asarray(time2), np.asarray(time_embed), np.asarray(pos), np.asarray(neg))
                 # find closest and furthest user pairs within sample for regularization
                 if args.triplet_loss or args.cos_loss:
                     batch_dist = distance_matrix(user_feat.T[u - 1], user_feat.T[u - 1])
@@ -106,7 +110,7 @@ def train_test(args, sampler, num_batch, model, dataset, epoch_start_idx, write,
                     neg_user = np.array([])
                 # model output 
                 pos_logits, neg_logits, embed, pos_embed, neg_embed = model(
-                    u, seq, time1, time2, time_embed, pos, neg, pos_user, neg_user
+                    u, seq, time1, time2, time_embed, pos, neg, pos_user, neg_user, pop_feats
                 )
                 pos_labels, neg_labels = torch.ones(
                     pos_logits.shape, device=args.device
@@ -143,11 +147,11 @@ def train_test(args, sampler, num_batch, model, dataset, epoch_start_idx, write,
                 for step in range(num_batch):
                     if not args.time_embed:
                         u, seq, time1, time2, pos, neg = sampler2.next_batch()
-                        u, seq, time1, time2, pos, neg = (np.array(u), np.array(seq), np.array(time1), np.array(time2), np.array(pos), np.array(neg))
+                        u, seq, time1, time2, pos, neg = (np.asarray(u), np.asarray(seq), np.asarray(time1), np.asarray(time2), np.asarray(pos), np.asarray(neg))
                         time_embed = None
                     else:
                         u, seq, time1, time2, time_embed, pos, neg = sampler2.next_batch()
-                        u, seq, time1, time2, time_embed, pos, neg = (np.array(u), np.array(seq), np.array(time1), np.array(time2), np.array(time_embed), np.array(pos), np.array(neg))
+                        u, seq, time1, time2, time_embed, pos, neg = (np.asarray(u), np.asarray(seq), np.asarray(time1), np.asarray(time2), np.asarray(time_embed), np.asarray(pos), np.asarray(neg))
                     pos_logits, neg_logits, embed, pos_embed, neg_embed = model2(
                         u, seq, time1, time2, time_embed, pos, neg, np.array([]), np.array([])
                     )
@@ -180,10 +184,10 @@ def train_test(args, sampler, num_batch, model, dataset, epoch_start_idx, write,
                 # get batch data
                 seqs, labels, t1, t2 = sampler.next_batch()
                 seqs, labels, t1, t2 = (
-                    np.array(seqs),
+                    np.asarray(seqs),
                     torch.LongTensor(labels).to(args.device).view(-1),
-                    np.array(t1),
-                    np.array(t2),
+                    np.asarray(t1),
+                    np.asarray(t2),
                 )
                 # model output
                 logits = model(seqs, t1, t2)
@@ -203,7 +207,7 @@ def train_test(args, sampler, num_batch, model, dataset, epoch_start_idx, write,
             for step in range(num_batch):
                 # get batch data
                 u, pos, neg = sampler.next_batch()
-                u, pos, neg = np.array(u), np.array(pos), np.array(neg)
+                u, pos, neg = np.asarray(u), np.asarray(pos), np.asarray(neg)
                 # model output
                 pos_logits, neg_logits = model(u, pos, neg)
                 adam_optimizer.zero_grad()
@@ -220,10 +224,10 @@ def train_test(args, sampler, num_batch, model, dataset, epoch_start_idx, write,
                 # get batch data
                 seqs, lens, pos, neg = sampler.next_batch()
                 seqs, lens, pos, neg = (
-                    np.array(seqs),
-                    torch.LongTensor(np.array(lens)).to(args.device),
-                    np.array(pos),
-                    np.array(neg),
+                    np.asarray(seqs),
+                    torch.LongTensor(np.asarray(lens)).to(args.device),
+                    np.asarray(pos),
+                    np.asarray(neg),
                 )
 
                 pos_logits, neg_logits, aug_loss = model(seqs, lens, pos, neg)
@@ -311,23 +315,36 @@ def train_test(args, sampler, num_batch, model, dataset, epoch_start_idx, write,
     f.close()
     if sampler:
         sampler.close()
+    if sampler2:
+        sampler2.close()
     print("Done")
 
 
 def train_test_mock(args, sampler, num_batch, model):
+    # raw popularity features of all batches go into one memmap, row i holding user index[i]
     try:
-        if not os.path.exists(f"../data/{args.dataset}/"):
-            os.makedirs(f"../data/{args.dataset}/")
+        feat_path = f"../data/{args.dataset}_raw_feat.npy"
+        index_path = f"../data/{args.dataset}_raw_feat_index.npy"
         label_path = f"../data/{args.dataset}_raw_feat_label.npy"
-        if os.path.exists(label_path):
-            os.remove(label_path)
+        for path in [feat_path, index_path, label_path]:
+            if os.path.exists(path):
+                os.remove(path)
+        feats = None
+        index = np.zeros(num_batch * args.batch_size, dtype=np.int32)
         np_batch = np.zeros((num_batch, args.batch_size), dtype=np.int32)
         for step in range(int(num_batch)):
             u, seq, time1, time2 = sampler.next_batch()
-            u, seq, time1, time2 = (np.array(u), np.array(seq), np.array(time1), np.array(time2))
+            u, seq, time1, time2 = (np.asarray(u), np.asarray(seq), np.asarray(time1), np.asarray(time2))
             pop_enc = model.raw(seq, time1, time2)
-            np.save(f"../data/{args.dataset}/raw_feat_{step}.npy", pop_enc)
+            if feats is None:
+                feats = np.lib.format.open_memmap(feat_path, mode="w+", dtype=pop_enc.dtype, shape=(len(index),) + pop_enc.shape[1:])
+            rows = slice(step * args.batch_size, (step + 1) * args.batch_size)
+            feats[rows] = pop_enc
+            index[rows] = u
             np_batch[step] = np.count_nonzero(seq, axis=1)
+        if feats is not None:
+            feats.flush()
+        np.save(index_path, index)
         np.save(label_path, np_batch)
     except:
         import pdb
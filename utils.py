@@ -4,274 +4,326 @@ import torch
 import random
 import numpy as np
 from collections import defaultdict, Counter
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, shared_memory
 import pdb
 import math
 from scipy.stats import rankdata, percentileofscore
 import pickle
-from operator import itemgetter
+import weakref
 import psutil
+from model_utils import load_table
+from data import UserShards, share_dataset, attach_dataset, attach_block, release_blocks
 
 
 # sampler for batch generation
-def random_neq(l, r, s):
-    t = np.random.randint(l, r)
-    while t in s:
-        t = np.random.randint(l, r)
-    return t
+def alias_table(weights):
+    """
+    Vose alias table for drawing index i with probability weights[i] / sum(weights) in constant time
+    """
+    n = len(weights)
+    scaled = np.asarray(weights, dtype=np.float64) * n / np.sum(weights)
+    accept = np.ones(n)
+    alias = np.arange(n)
+    small = list(np.nonzero(scaled < 1)[0])
+    large = list(np.nonzero(scaled >= 1)[0])
+    while small and large:
+        s, l = small.pop(), large.pop()
+        accept[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= 1 - scaled[s]
+        (small if scaled[l] < 1 else large).append(l)
+    return accept, alias
+
+
+class NegativeSampler(object):
+    """
+    negatives for many rows (usually users) at once, never one of the row's seen items
+    seen items are a CSR index: row r's sorted items are keys[offsets[r]:offsets[r+1]] - r * span
+    candidates are drawn in bulk, checked with one searchsorted and only the rejected positions are redrawn
+    draws are uniform over 1..itemnum, or follow pop (weights of items 1..itemnum, e.g. rawpop) through an alias table
+    """
+    def __init__(self, keys, offsets, itemnum, pop=None):
+        self.keys = keys
+        self.offsets = offsets
+        self.itemnum = itemnum
+        self.span = itemnum + 1
+        self.table = None if pop is None else alias_table(pop)
+
+    @classmethod
+    def from_pairs(cls, owner, items, itemnum, pop=None):
+        """
+        row owner[i] has seen items[i]
+        """
+        keys = np.sort(np.asarray(owner, dtype=np.int64) * (itemnum + 1) + items)
+        rows = int(owner.max()) + 1 if len(owner) else 0
+        return cls(keys, np.searchsorted(keys, np.arange(rows + 1, dtype=np.int64) * (itemnum + 1)), itemnum, pop)
+
+    @classmethod
+    def from_histories(cls, histories, itemnum, pop=None, held=()):
+        """
+        rows are user ids, seen items are the user's history plus the per-user items in held (e.g. valid and test)
+        """
+        owner, items = histories.flat()
+        ids = np.arange(len(histories.offsets) - 1)
+        owner = np.concatenate([owner] + [ids[:len(h)] for h in held])
+        items = np.concatenate([items] + [np.asarray(h)[:len(ids)] for h in held])
+        return cls.from_pairs(owner, items, itemnum, pop)
+
+    @classmethod
+    def from_rows(cls, rows, itemnum, pop=None):
+        """
+        rows are the rows of a 2-D array of item ids, zeros are padding
+        """
+        owner, cols = np.nonzero(rows)
+        return cls.from_pairs(owner, rows[owner, cols], itemnum, pop)
+
+    def draw(self, size):
+        if self.table is None:
+            return np.random.randint(1, self.itemnum + 1, size=size)
+        accept, alias = self.table
+        idx = np.random.randint(len(accept), size=size)
+        return np.where(np.random.random(size) < accept[idx], idx, alias[idx]) + 1
+
+    def seen(self, keys):
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=bool)
+        return self.keys[np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)] == keys
+
+    def sample(self, rows, mask, distinct=False):
+        """
+        a negative at every True position of the 2-D mask, row i of the mask belonging to row id rows[i]
+        with distinct, the negatives of a row are also all different from each other
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        neg = np.zeros(mask.shape, dtype=np.int32)
+        todo_rows, todo_cols = np.nonzero(mask)
+        while len(todo_rows) > 0:
+            cand = self.draw(len(todo_rows))
+            ok = ~self.seen(rows[todo_rows] * self.span + cand)
+            neg[todo_rows[ok], todo_cols[ok]] = cand[ok]
+            if distinct:
+                # of equal items in a row, keep the one placed in an earlier pass, then the leftmost
+                fresh = np.zeros(mask.shape, dtype=bool)
+                fresh[todo_rows[ok], todo_cols[ok]] = True
+                keys = (np.arange(len(neg))[:, None] * self.span + neg).ravel()
+                order = np.lexsort((fresh.ravel(), keys))
+                dup = order[1:][(keys[order[1:]] == keys[order[:-1]]) & (neg.ravel()[order[1:]] != 0)]
+                neg.ravel()[dup] = 0
+                ok[:] = neg[todo_rows, todo_cols] != 0
+            todo_rows, todo_cols = todo_rows[~ok], todo_cols[~ok]
+        return neg
 
 
 def sample_function_newrec(
-    user_train, usernum, itemnum, batch_size, maxlen, mask_prob, result_queue, SEED
+    user_train, usernum, itemnum, batch_size, maxlen, mask_prob, result_queue, SEED, features=None
 ):
-    def sample():
-        user = np.random.randint(1, usernum + 1)
-        while np.sum(np.array(user_train[0][user]) != 0) <= 1:
-            user = np.random.randint(1, usernum + 1)
-
-        # seq = np.zeros([maxlen], dtype=np.int32)
-        # time1 = np.zeros([maxlen], dtype=np.int32)
-        # time2 = np.zeros([maxlen], dtype=np.int32)
-        seq = np.array(user_train[0][user][:maxlen], dtype=np.int32)
-        time1 = np.array(user_train[1][user], dtype=np.int32)
-        time2 = np.array(user_train[2][user], dtype=np.int32)
-        if len(user_train) > 3:
-            time_embed = np.array(user_train[3][user], dtype=np.int32)
-        pos = np.zeros([maxlen], dtype=np.int32)
-        neg = np.zeros([maxlen], dtype=np.int32)
-        nxt = user_train[0][user][-1]
-        idx = maxlen - 1
-
-        ts = set(user_train[0][user])
-        for i in reversed(user_train[0][user][:-1]):
-            # seq[idx] = i[0]
-            # time1[idx] = i[1]
-            # time2[idx] = i[2]
-            pos[idx] = nxt
-            if nxt != 0:
-                neg[idx] = random_neq(1, itemnum + 1, ts)
-            nxt = i
-            idx -= 1
-            if idx == -1:
-                break
-
-        if len(user_train) > 3:
-            return (user, seq, time1, time2, time_embed, pos, neg)
-        return (user, seq, time1, time2, pos, neg)
-
+    # whole batches at once: users drawn from those with at least 2 training items, pos is the window shifted by one
+    # and negatives avoid the items in the user's window, like the per-user sampler this replaced
+    # with features (a PopularityFeatures), the history, pos and neg popularity features are appended to each batch
+    eligible = np.nonzero(user_train[0].lengths() > 1)[0]
     np.random.seed(SEED)
     while True:
-        one_batch = []
-        for i in range(batch_size):
-            one_batch.append(sample())
-        result_queue.put(zip(*one_batch))
+        user = eligible[np.random.randint(len(eligible), size=batch_size)]
+        items = user_train[0].window(user)
+        seq = items[:, :maxlen]
+        time1 = user_train[1].window(user)
+        time2 = user_train[2].window(user)
+        pos = items[:, 1:]
+        neg = NegativeSampler.from_rows(items, itemnum).sample(np.arange(batch_size), pos != 0)
+        if len(user_train) > 3:
+            batch = (user, seq, time1, time2, user_train[3].window(user), pos, neg)
+        else:
+            batch = (user, seq, time1, time2, pos, neg)
+        if features is not None:
+            batch += features(seq, time1, time2, pos, neg)
+        result_queue.put(batch)
 
 
 def sample_function_newrec_rfo(
-    user_comb, usernum, itemnum, batch_size, maxlen, result_queue, userpop,
+    user_comb, usernum, itemnum, batch_size, maxlen, result_queue, chunks,
 ):
+    # one batch per chunk of users: the training window followed by the valid and test items
     user_train, user_valid, user_test = user_comb
-    def sample(user):
-        if np.sum(np.array(user_train[0][user]) != 0) <= 1:
+    for users in chunks:
+        if (user_train[0].lengths(users) <= 1).any():
             raise ValueError("Must have at least 2 items.")
-        seq = np.array(user_train[0][user] + [user_valid[0][user]] + [user_test[0][user]], dtype=np.int32)
-        time1 = np.array(user_train[1][user] + [user_valid[1][user]] + [user_test[1][user]], dtype=np.int32)
-        time2 = np.array(user_train[2][user] + [user_valid[2][user]] + [user_test[2][user]], dtype=np.int32)
-        return (user, seq, time1, time2)
-
-    one_batch = []
-    for i in range(batch_size):
-        one_batch.append(sample(userpop[i]))
-    result_queue.put(zip(*one_batch))
+        seq, time1, time2 = (
+            np.concatenate([train.window(users), valid[users, None], test[users, None]], axis=1).astype(np.int32)
+            for train, valid, test in zip(user_train[:3], user_valid[:3], user_test[:3])
+        )
+        result_queue.put((users, seq, time1, time2))
 
 
 def sample_function_sasrec(
-    user_train, usernum, itemnum, batch_size, maxlen, mask_prob, result_queue, SEED
+    user_train, usernum, itemnum, batch_size, maxlen, mask_prob, result_queue, SEED, negatives=None
 ):
-    def sample():
-        user = np.random.randint(1, usernum + 1)
-        while len(user_train[user]) <= 1:
-            user = np.random.randint(1, usernum + 1)
-
-        seq = np.zeros([maxlen], dtype=np.int32)
-        pos = np.zeros([maxlen], dtype=np.int32)
-        neg = np.zeros([maxlen], dtype=np.int32)
-        nxt = user_train[user][-1]
-        idx = maxlen - 1
-
-        ts = set(user_train[user])
-        for i in reversed(user_train[user][:-1]):
-            seq[idx] = i
-            pos[idx] = nxt
-            if nxt != 0:
-                neg[idx] = random_neq(1, itemnum + 1, ts)
-            nxt = i
-            idx -= 1
-            if idx == -1:
-                break
-
-        return (user, seq, pos, neg)
-
+    # whole batches at once: seq and pos are the last maxlen + 1 items split with a shift of one,
+    # negatives avoid the user's whole training history
+    eligible = np.nonzero(user_train.lengths() > 1)[0]
+    if negatives is None:
+        negatives = NegativeSampler.from_histories(user_train, itemnum)
     np.random.seed(SEED)
     while True:
-        one_batch = []
-        for i in range(batch_size):
-            one_batch.append(sample())
-
-        result_queue.put(zip(*one_batch))
+        user = eligible[np.random.randint(len(eligible), size=batch_size)]
+        items = user_train.window(user, maxlen + 1)
+        pos = items[:, 1:]
+        neg = negatives.sample(user, pos != 0)
+        result_queue.put((user, items[:, :-1], pos, neg))
+
+
+def cloze(items, itemnum, mask_prob):
+    """
+    BERT-style masking of a padded (batch, maxlen) item array, returns tokens and labels
+    each item is masked with probability mask_prob and then replaced by 0 (80%), a random item (10%) or kept (10%),
+    all decided by one random matrix, labels hold the masked items and 0 elsewhere
+    """
+    prob = np.random.random(items.shape)
+    masked = (prob < mask_prob) & (items != 0)
+    prob = prob / mask_prob if mask_prob > 0 else prob
+    tokens = np.where(masked & (prob < 0.8), 0, items)
+    replace = masked & (prob >= 0.8) & (prob < 0.9)
+    tokens[replace] = np.random.randint(1, itemnum + 1, size=int(replace.sum()))
+    return tokens, np.where(masked, items, 0)
 
 
 def sample_function_newb4rec(
     user_train, usernum, itemnum, batch_size, maxlen, mask_prob, result_queue, SEED
 ):
-    def sample():
-        user = np.random.randint(1, usernum + 1)
-        while len(user_train[user]) <= 1:
-            user = np.random.randint(1, usernum + 1)
-
-        tokens = []
-        t1 = []
-        t2 = []
-        labels = []
-        for s in user_train[user]:
-            prob = np.random.random()
-            if prob < mask_prob:
-                prob /= mask_prob
-                if prob < 0.8:
-                    tokens.append(0)
-                elif prob < 0.9:
-                    tokens.append(np.random.randint(1, itemnum + 1))
-                else:
-                    tokens.append(s[0])
-                labels.append(s[0])
-            else:
-                tokens.append(s[0])
-                labels.append(0)
-            t1.append(s[1])
-            t2.append(s[2])
-
-        tokens = tokens[-maxlen:]
-        labels = labels[-maxlen:]
-        t1 = t1[-maxlen:]
-        t2 = t2[-maxlen:]
-        mask_len = maxlen - len(tokens)
-        tokens = [0] * mask_len + tokens
-        labels = [0] * mask_len + labels
-        t1 = [0] * mask_len + t1
-        t2 = [0] * mask_len + t2
-
-        return tokens, labels, t1, t2
-
+    # whole batches of the last maxlen items of users with at least 2, with their time1 and time2 channels
+    eligible = np.nonzero(user_train[0].lengths() > 1)[0]
     np.random.seed(SEED)
     while True:
-        one_batch = []
-        for i in range(batch_size):
-            one_batch.append(sample())
-
-        result_queue.put(zip(*one_batch))
+        user = eligible[np.random.randint(len(eligible), size=batch_size)]
+        tokens, labels = cloze(user_train[0].window(user, maxlen), itemnum, mask_prob)
+        result_queue.put((tokens, labels, user_train[1].window(user, maxlen), user_train[2].window(user, maxlen)))
 
 
 def sample_function_bert4rec(
     user_train, usernum, itemnum, batch_size, maxlen, mask_prob, result_queue, SEED
 ):
-    def sample():
-        user = np.random.randint(1, usernum + 1)
-        while len(user_train[user]) <= 1:
-            user = np.random.randint(1, usernum + 1)
-
-        tokens = []
-        labels = []
-        for s in user_train[user]:
-            prob = np.random.random()
-            if prob < mask_prob:
-                prob /= mask_prob
-                if prob < 0.8:
-                    tokens.append(0)
-                elif prob < 0.9:
-                    tokens.append(np.random.randint(1, itemnum + 1))
-                else:
-                    tokens.append(s)
-                labels.append(s)
-            else:
-                tokens.append(s)
-                labels.append(0)
-
-        tokens = tokens[-maxlen:]
-        labels = labels[-maxlen:]
-        mask_len = maxlen - len(tokens)
-        tokens = [0] * mask_len + tokens
-        labels = [0] * mask_len + labels
-
-        return tokens, labels
-
+    # whole batches of the last maxlen items of users with at least 2
+    eligible = np.nonzero(user_train.lengths() > 1)[0]
     np.random.seed(SEED)
     while True:
-        one_batch = []
-        for i in range(batch_size):
-            one_batch.append(sample())
-
-        result_queue.put(zip(*one_batch))
+        user = eligible[np.random.randint(len(eligible), size=batch_size)]
+        result_queue.put(cloze(user_train.window(user, maxlen), itemnum, mask_prob))
 
 
 def sample_function_bprmf(
-    user_train, usernum, itemnum, batch_size, maxlen, mask_prob, result_queue, SEED
+    user_train, usernum, itemnum, batch_size, maxlen, mask_prob, result_queue, SEED, negatives=None
 ):
-    def sample():
-        user = np.random.randint(1, usernum + 1)
-        while len(user_train[user]) <= 1:
-            user = np.random.randint(1, usernum + 1)
-        pos = np.pad(
-            np.random.permutation(user_train[user]),
-            (0, maxlen - len(user_train[user])),
-            "constant",
-        )
-        neg = np.zeros([maxlen], dtype=np.int32)
-        ts = set(user_train[user])
-        for i in range(len(user_train[user])):
-            neg[i] = random_neq(1, itemnum + 1, ts)
-        return user, pos, neg
-
+    # flat (user, pos, neg) triples of batch_size, pos drawn uniformly over the training interactions
+    # of users with at least 2, so batches do not depend on the longest history
+    if negatives is None:
+        negatives = NegativeSampler.from_histories(user_train, itemnum)
+    lens = user_train.lengths()
+    lens[lens <= 1] = 0
+    ends = np.cumsum(lens)
     np.random.seed(SEED)
     while True:
-        one_batch = []
-        for i in range(batch_size):
-            one_batch.append(sample())
+        k = np.random.randint(ends[-1], size=batch_size)
+        user = np.searchsorted(ends, k, side="right")
+        pos = user_train.values[user_train.offsets[user] + k - (ends[user] - lens[user])]
+        neg = negatives.sample(user, np.ones((batch_size, 1), dtype=bool))[:, 0]
+        result_queue.put((user, pos, neg))
 
-        result_queue.put(zip(*one_batch))
 
 def sample_function_cl4srec(
-    user_train, usernum, itemnum, batch_size, maxlen, seq_lens, result_queue, SEED
+    user_train, usernum, itemnum, batch_size, maxlen, seq_lens, result_queue, SEED, negatives=None
 ):
-    def sample():
-        user = np.random.randint(1, usernum + 1)
-        while len(user_train[user]) <= 1:
-            user = np.random.randint(1, usernum + 1)
-
-        seq = np.zeros([maxlen], dtype=np.int32)
-        pos = np.zeros([maxlen], dtype=np.int32)
-        neg = np.zeros([maxlen], dtype=np.int32)
-        nxt = user_train[user][-1]
-        idx = maxlen - 1
-
-        ts = set(user_train[user])
-        for i in reversed(user_train[user][:-1]):
-            seq[idx] = i
-            pos[idx] = nxt
-            if nxt != 0:
-                neg[idx] = random_neq(1, itemnum + 1, ts)
-            nxt = i
-            idx -= 1
-            if idx == -1:
-                break
-        return (seq, seq_lens[user], pos, neg)
-
+    # same batches as sample_function_sasrec, with the sequence lengths in place of the users
+    eligible = np.nonzero(user_train.lengths() > 1)[0]
+    if negatives is None:
+        negatives = NegativeSampler.from_histories(user_train, itemnum)
     np.random.seed(SEED)
     while True:
-        one_batch = []
-        for i in range(batch_size):
-            one_batch.append(sample())
+        user = eligible[np.random.randint(len(eligible), size=batch_size)]
+        items = user_train.window(user, maxlen + 1)
+        pos = items[:, 1:]
+        result_queue.put((items[:, :-1], seq_lens[user], pos, negatives.sample(user, pos != 0)))
+
+class BatchRing(object):
+    """
+    fixed pool of shared memory batch slots from sampler workers to the trainer, used in place of a result Queue
+    put() copies each field of a batch into a free slot as a contiguous array and only the slot index crosses processes
+    get() returns views of the slot, which stay valid until the next get()
+    """
+    FIELDS = 12
+    # int64 slot header: number of fields, then dtype char, ndim and 3 dims per field
+    HEADER = 8 * (1 + 5 * FIELDS)
+
+    def __init__(self, slots, slot_bytes):
+        self.slot_bytes = self.HEADER + slot_bytes
+        self.block = shared_memory.SharedMemory(create=True, size=slots * self.slot_bytes)
+        self.free = Queue()
+        self.ready = Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+        self.held = None
+        self.release = weakref.finalize(self, release_blocks, [self.block])
+
+    def __getstate__(self):
+        return (self.block.name, self.slot_bytes, self.free, self.ready)
+
+    def __setstate__(self, state):
+        name, self.slot_bytes, self.free, self.ready = state
+        self.block = attach_block(name)
+        self.held = None
+
+    def put(self, batch):
+        fields = [np.ascontiguousarray(field) for field in batch]
+        if len(fields) > self.FIELDS or any(field.ndim > 3 or field.dtype.hasobject for field in fields):
+            raise ValueError(f"batch slots hold at most {self.FIELDS} numeric fields of up to 3 dimensions")
+        if sum(-(-field.nbytes // 8) * 8 for field in fields) > self.slot_bytes - self.HEADER:
+            raise ValueError(f"batch of {sum(field.nbytes for field in fields)} bytes does not fit a {self.slot_bytes - self.HEADER} byte slot")
+        slot = self.free.get()
+        start = slot * self.slot_bytes
+        header = np.ndarray(self.HEADER // 8, np.int64, buffer=self.block.buf, offset=start)
+        header[0] = len(fields)
+        offset = start + self.HEADER
+        for i, field in enumerate(fields):
+            header[1 + 5 * i:6 + 5 * i] = (ord(field.dtype.char), field.ndim, *(field.shape + (1, 1, 1))[:3])
+            np.ndarray(field.shape, field.dtype, buffer=self.block.buf, offset=offset)[...] = field
+            offset += -(-field.nbytes // 8) * 8
+        self.ready.put(slot)
+
+    def get(self):
+        if self.held is not None:
+            self.free.put(self.held)
+        self.held = slot = self.ready.get()
+        start = slot * self.slot_bytes
+        header = np.ndarray(self.HEADER // 8, np.int64, buffer=self.block.buf, offset=start)
+        offset = start + self.HEADER
+        fields = []
+        for i in range(header[0]):
+            char, ndim, *shape = header[1 + 5 * i:6 + 5 * i].tolist()
+            field = np.ndarray(tuple(shape[:ndim]), np.dtype(chr(char)), buffer=self.block.buf, offset=offset)
+            fields.append(field)
+            offset += -(-field.nbytes // 8) * 8
+        return tuple(fields)
+
+    def close(self):
+        self.release()
+
+
+def run_shared(func, spec, *args, negatives=None, **kwargs):
+    """
+    sampler worker entry point: attach to the histories WarpSampler put in shared memory and run func on them
+    negatives is the shared (keys, offsets, itemnum) index of a NegativeSampler built once by WarpSampler
+    """
+    User, blocks = attach_dataset(spec)
+    if negatives is not None:
+        index, index_blocks = attach_dataset(negatives)
+        kwargs["negatives"] = NegativeSampler(*index)
+    func(User, *args, **kwargs)
+
+
+def stop_workers(processors, blocks):
+    for p in processors:
+        p.terminate()
+        p.join()
+    release_blocks(blocks)
 
-        result_queue.put(zip(*one_batch))
 
 class WarpSampler(object):
     # @profile
@@ -288,39 +340,40 @@ class WarpSampler(object):
         augment=False,
         raw_feature_only=False,
         misc=None,
+        pin_memory=False,
+        features=None,
     ):
-        self.result_queue = Queue(maxsize=n_workers * 10)
         self.processors = []
+        self.pin_memory = pin_memory
+        # workers attach to one shared copy of the histories instead of each unpickling their own
+        spec, self.blocks = share_dataset(User)
+        self.release = weakref.finalize(self, stop_workers, self.processors, self.blocks)
 
         if raw_feature_only:
-            def extract_subset(user_comb, keys):
-                user_train, user_valid, user_test = user_comb
-                train_subset = tuple({key: d[key] for key in keys if key in d} for d in user_train)
-                valid_subset = tuple({key: d[key] for key in keys if key in d} for d in user_valid)
-                test_subset = tuple({key: d[key] for key in keys if key in d} for d in user_test)
-                return (train_subset, valid_subset, test_subset)
-
             userint = misc
             userpop = np.argsort(userint) + 1
             print("USER INT LENGTH", len(userpop))
-            nworkers = int((len(userpop)) // batch_size)
-            self.result_queue = Queue(maxsize=nworkers)
-            chunks = [userpop[i * batch_size:(i + 1) * batch_size] for i in range(nworkers)]
+            nbatches = int((len(userpop)) // batch_size)
+            chunks = [userpop[i * batch_size:(i + 1) * batch_size] for i in range(nbatches)]
+            # a fixed pool of workers streams the chunks, worker i taking every n_workers-th one
+            nworkers = min(n_workers, nbatches)
+            # seq, time1 and time2 are maxlen + 3 wide: the training window plus valid and test
+            self.result_queue = BatchRing(2 * nworkers, 4 * batch_size * (maxlen + 3) * 8)
             func = sample_function_newrec_rfo
             for i in range(nworkers):
                 print(f"starting worker {i}")
-                user_subset = extract_subset(User, chunks[i])
                 self.processors.append(
                     Process(
-                        target=func,
+                        target=run_shared,
                         args=(
-                            user_subset,
+                            func,
+                            spec,
                             usernum,
                             itemnum,
                             batch_size,
                             maxlen,
                             self.result_queue,
-                            chunks[i],
+                            chunks[i::nworkers],
                         ),
                     )
                 )
@@ -341,16 +394,32 @@ class WarpSampler(object):
             func = sample_function_bert4rec
         elif model == "bprmf":
             func = sample_function_bprmf
-            maxlen = max([len(x) for x in User.values()])
         elif model == "cl4srec":
             func = sample_function_cl4srec
             user_lens = misc
+        # batches come back through shared memory slots sized for up to 8 int64 fields of
+        # batch_size x (maxlen + 1), two slots per worker
+        kwargs = {}
+        slot_bytes = 8 * batch_size * (maxlen + 1) * 8
+        if features is not None:
+            if model != "newrec":
+                raise ValueError("sampler popularity features are newrec only")
+            # float32 history, pos and neg features of input_units1 + input_units2 per position
+            kwargs["features"] = features
+            slot_bytes += 3 * batch_size * maxlen * (features.input1 + features.input2) * 4
+        self.result_queue = BatchRing(2 * n_workers, slot_bytes)
+        if model in ["sasrec", "bprmf", "cl4srec"]:
+            # the seen-item index is as large as the histories, so it is built once and shared as well
+            negatives = NegativeSampler.from_histories(User, itemnum)
+            kwargs["negatives"], blocks = share_dataset((negatives.keys, negatives.offsets, itemnum))
+            self.blocks.extend(blocks)
         for i in range(n_workers):
             self.processors.append(
                 Process(
-                    target=func,
+                    target=run_shared,
                     args=(
-                        User,
+                        func,
+                        spec,
                         usernum,
                         itemnum,
                         batch_size,
@@ -359,55 +428,87 @@ class WarpSampler(object):
                         self.result_queue,
                         np.random.randint(2e9),
                     ),
+                    kwargs=kwargs,
                 )
             )
             self.processors[-1].daemon = True
             self.processors[-1].start()
 
     def next_batch(self):
-        return self.result_queue.get()
+        """
+        numpy views of the next batch, valid until the following call, or pinned torch tensors with pin_memory
+        """
+        batch = self.result_queue.get()
+        if self.pin_memory:
+            return tuple(torch.from_numpy(np.asarray(field)).pin_memory() for field in batch)
+        return batch
 
     def close(self):
-        for p in self.processors:
-            p.terminate()
-            p.join()
+        self.release()
+        if isinstance(self.result_queue, BatchRing):
+            self.result_queue.close()
+
+
+class ShardedSampler(object):
+    """
+    WarpSampler over a UserShards dataset with one shard loaded at a time
+    each shard serves its share of an epoch's batches before its workers are replaced by the next shard's
+    """
+
+    def __init__(self, shards, model, batch_size=64, maxlen=10, n_workers=1, mask_prob=0, features=None):
+        self.shards = shards
+        self.model = model
+        self.options = dict(batch_size=batch_size, maxlen=maxlen, n_workers=n_workers, mask_prob=mask_prob, features=features)
+        # a shard's share of batches follows its users, or its interactions for bprmf's single-interaction batches
+        sizes = shards.interactions() if model == "bprmf" else np.diff(shards.bounds)
+        self.quota = np.maximum(1, sizes // batch_size)
+        self.shard = -1
+        self.left = 0
+        self.sampler = None
+
+    def next_batch(self):
+        if self.left == 0:
+            if self.sampler is not None:
+                self.sampler.close()
+            self.shard = (self.shard + 1) % len(self.shards)
+            dataset = self.shards[self.shard]
+            misc = dataset[5] if len(dataset) > 5 else None
+            self.sampler = WarpSampler(dataset[0], dataset[3], dataset[4], self.model, misc=misc, **self.options)
+            self.left = self.quota[self.shard]
+        self.left -= 1
+        return self.sampler.next_batch()
+
+    def close(self):
+        if self.sampler is not None:
+            self.sampler.close()
 
 
 def setup_negatives(dataset, dataname, mod, args):
-    train, valid, test, usernum, itemnum = dataset
-    print(usernum, itemnum)
-    users = range(1, usernum + 1)
-    usersneg = {}
-    if args.userneg == "userneg":
-        for u in users:
-            rated = set(train[0][u])
-            rated.add(valid[0][u])
-            rated.add(test[0][u])
-            negs = []
-            for _ in range(100):
-                t = np.random.randint(1, itemnum + 1)
-                while t in rated:
-                    t = np.random.randint(1, itemnum + 1)
-                rated.add(t)
-                negs.append(t)
-            usersneg[u] = negs
+    # a sharded dataset is walked one shard at a time
+    if isinstance(dataset, UserShards):
+        shards = dataset
+        print(dataset.usernum, dataset.itemnum)
     else:
-        lastpop = np.loadtxt(f"../data/{args.dataset}_{mod}{args.rawpop}.txt")
+        shards = [dataset]
+        print(dataset[3], dataset[4])
+    usersneg = {}
+    if args.userneg != "userneg":
+        lastpop = load_table(f"../data/{args.dataset}_{mod}{args.rawpop}.txt")
         if lastpop.ndim == 2:
             lastpop = lastpop[-1]
-        lastprob = lastpop/np.sum(lastpop)
-        for u in users:
-            rated = set(train[0][u])
-            rated.add(valid[0][u])
-            rated.add(test[0][u])
-            negs = []
-            for _ in range(100):
-                t = np.random.choice(np.arange(1, itemnum+1), p=lastprob)
-                while t in rated:
-                    t = np.random.choice(np.arange(1, itemnum+1), p=lastprob)
-                rated.add(t)
-                negs.append(t)
-            usersneg[u] = negs
+    else:
+        lastpop = None
+    table = None if lastpop is None else alias_table(lastpop)
+    for train, valid, test, usernum, itemnum in (shard[:5] for shard in shards):
+        # 100 distinct items per user outside its training window (train[0][u]), valid and test item,
+        # uniform or weighted by the last popularity
+        users = np.arange(train[0].first, usernum + 1)
+        for chunk in np.array_split(users, max(1, len(users) // 10000)):
+            rated = np.concatenate([train[0].window(chunk), valid[0][chunk, None], test[0][chunk, None]], axis=1)
+            negatives = NegativeSampler.from_rows(rated, itemnum)
+            negatives.table = table
+            negs = negatives.sample(np.arange(len(chunk)), np.ones((len(chunk), 100), dtype=bool), distinct=True)
+            usersneg.update(zip(chunk.tolist(), negs.tolist()))
     with open(f"../data/{dataname}_{mod}{args.userneg}.pickle", 'wb') as handle:
         pickle.dump(usersneg, handle, protocol=pickle.HIGHEST_PROTOCOL)
     print("finished negative setup for " + dataname)
@@ -447,7 +548,10 @@ def evaluate(model, dataset, args, mode, usernegs, second=False):
 
     valid_user = 0.0
 
-    if args.augment:
+    if isinstance(dataset, UserShards):
+        train = valid = test = None
+        usernum, itemnum = dataset.usernum, dataset.itemnum
+    elif args.augment:
         [train, valid, test, usernum, itemnum, userdict] = dataset
     elif args.model not in ["cl4srec"]:
         [train, valid, test, usernum, itemnum] = dataset
@@ -457,12 +561,15 @@ def evaluate(model, dataset, args, mode, usernegs, second=False):
     evaluate = test if mode == "test" else valid
 
     if args.model == "mostpop":
-        misc = np.loadtxt(f"../data/{load}_{args.rawpop}.txt")
+        misc = load_table(f"../data/{load}_{args.rawpop}.txt")
     else:
         misc = None
 
     if args.model in ["newrec", "bert4rec", "sasrec", "bprmf", "cl4srec"]:
-        ranks, predusers = predict(model, evaluate, train, valid, test, itemnum, args, mode, usernegs, users)
+        if isinstance(dataset, UserShards):
+            ranks, predusers = predict_shards(predict, model, dataset, args, mode, usernegs)
+        else:
+            ranks, predusers = predict(model, evaluate, train, valid, test, itemnum, args, mode, usernegs, users)
         if args.pause:
             np.savetxt(f"../data/{args.dataset}_{args.model}_ranks_{args.time_df_mod}.txt", ranks)
             sys.exit()
@@ -576,20 +683,43 @@ def evaluate(model, dataset, args, mode, usernegs, second=False):
     print(metrics)
     return metrics
 
+def predict_shards(predict, model, shards, args, mode, usernegs):
+    """
+    ranks and users from predict over every shard of a UserShards dataset, loading one shard at a time
+    """
+    # predict reads score files and writes rank/score outputs per call, which would misalign or overwrite across shards
+    if args.use_scores or args.save_scores or args.save_ranks:
+        raise ValueError("--num_shards cannot be combined with --use_scores, --save_scores or --save_ranks")
+    ranks, predusers = [], []
+    for train, valid, test, usernum, itemnum in (shard[:5] for shard in shards):
+        users = np.arange((train[0] if isinstance(train, tuple) else train).first, usernum + 1, dtype=np.int32)
+        shard_ranks, shard_users = predict(model, test if mode == "test" else valid, train, valid, test, itemnum, args, mode, usernegs, users)
+        ranks.append(shard_ranks)
+        predusers.append(shard_users)
+    return np.concatenate(ranks), np.concatenate(predusers)
+
+
+def user_negatives(usernegs, users):
+    """
+    (len(users), negatives per user) array of the evaluation negatives of users, also for a shard with zero or one user
+    """
+    width = len(next(iter(usernegs.values()))) if usernegs else 0
+    return np.array([usernegs[u] for u in users], dtype=int).reshape(len(users), width)
+
 # predict(
 #             model, evaluate[u], train[u], valid[u], test[u], itemnum, args, mode, usernegs[u], misc
 #         )
 def newpredict_newrec(model, evaluate, train, valid, test, itemnum, args, mode, usernegs, users):
-    seqs = np.array(list(itemgetter(*users)(train[0])))
-    t1s = np.array(list(itemgetter(*users)(train[1])))
-    t2s = np.array(list(itemgetter(*users)(train[2])))
+    seqs = train[0].window(users)
+    t1s = train[1].window(users)
+    t2s = train[2].window(users)
     if not args.sparse or args.override_sparse:
-        seqs_valid = np.array(list(itemgetter(*users)(valid[0])))
-        t1s_valid = np.array(list(itemgetter(*users)(valid[1])))
-        t2s_valid = np.array(list(itemgetter(*users)(valid[2])))
-    seqs_test = np.array(list(itemgetter(*users)(test[0])))
-    t1s_test = np.array(list(itemgetter(*users)(test[1])))
-    t2s_test = np.array(list(itemgetter(*users)(test[2])))
+        seqs_valid = valid[0][users]
+        t1s_valid = valid[1][users]
+        t2s_valid = valid[2][users]
+    seqs_test = test[0][users]
+    t1s_test = test[1][users]
+    t2s_test = test[2][users]
     if mode == "test":
         if not args.no_valid_in_test and (not args.sparse or args.override_sparse):
             seqs = np.concatenate((seqs, np.expand_dims(seqs_valid, -1)), axis=1)
@@ -599,13 +729,13 @@ def newpredict_newrec(model, evaluate, train, valid, test, itemnum, args, mode,
         item_t1s = t1s_test
         item_t2s = t2s_test
         if args.time_embed:
-            tes = np.array(list(itemgetter(*users)(test[3])))
+            tes = test[3].window(users)
     else:
         item_idxs = seqs_valid
         item_t1s = t1s_valid
         item_t2s = t2s_valid
         if args.time_embed:
-            tes = np.array(list(itemgetter(*users)(valid[3])))
+            tes = valid[3].window(users)
     seqs = seqs[:, -args.maxlen:]
     t1s = t1s[:, -args.maxlen:]
     t2s = t2s[:, -args.maxlen:]
@@ -620,7 +750,7 @@ def newpredict_newrec(model, evaluate, train, valid, test, itemnum, args, mode,
     for i in range(partitions):
         user_subset = users[subset*i:subset*(i+1)]
         if args.eval_method == 1:
-            negs = np.array(list(itemgetter(*user_subset)(usernegs)))
+            negs = user_negatives(usernegs, user_subset)
         elif args.eval_method == 3:
             negs = (np.arange(1, itemnum+1) + np.zeros((len(user_subset), 1))).astype(int) 
 
@@ -693,31 +823,31 @@ def newpredict_newrec(model, evaluate, train, valid, test, itemnum, args, mode,
         sys.exit()
     if args.save_ranks:
         np.savetxt('/'.join(args.state_dict_path.split('/')[:-1]) + f"/{args.ranks_name}.txt", fullranks)
-    return fullranks, np.array(list(usernegs.keys()))[cond]
+    return fullranks, np.asarray(users)[cond]
 
 
 
 def newrec_user(model, evaluate, train, valid, test, itemnum, args, mode, usernegs, users):
-    seqs = np.array(list(itemgetter(*users)(train[0])))
-    t1s = np.array(list(itemgetter(*users)(train[1])))
-    t2s = np.array(list(itemgetter(*users)(train[2])))
+    seqs = train[0].window(users)
+    t1s = train[1].window(users)
+    t2s = train[2].window(users)
     if not args.sparse:
-        seqs_valid = np.array(list(itemgetter(*users)(valid[0])))
-        t1s_valid = np.array(list(itemgetter(*users)(valid[1])))
-        t2s_valid = np.array(list(itemgetter(*users)(valid[2])))
-    seqs_test = np.array(list(itemgetter(*users)(test[0])))
-    t1s_test = np.array(list(itemgetter(*users)(test[1])))
-    t2s_test = np.array(list(itemgetter(*users)(test[2])))
+        seqs_valid = valid[0][users]
+        t1s_valid = valid[1][users]
+        t2s_valid = valid[2][users]
+    seqs_test = test[0][users]
+    t1s_test = test[1][users]
+    t2s_test = test[2][users]
     if mode == "test":
         if not args.no_valid_in_test:
             seqs = np.concatenate((seqs, np.expand_dims(seqs_valid, -1)), axis=1)
             t1s = np.concatenate((t1s, np.expand_dims(t1s_valid, -1)), axis=1)
             t2s = np.concatenate((t2s, np.expand_dims(t2s_valid, -1)), axis=1)
         if args.time_embed:
-            tes = np.array(list(itemgetter(*users)(test[3])))
+            tes = test[3].window(users)
     else:
         if args.time_embed:
-            tes = np.array(list(itemgetter(*users)(valid[3])))
+            tes = valid[3].window(users)
     seqs = seqs[:, -args.maxlen:]
     t1s = t1s[:, -args.maxlen:]
     t2s = t2s[:, -args.maxlen:]
@@ -748,11 +878,9 @@ def newrec_user(model, evaluate, train, valid, test, itemnum, args, mode, userne
 
 
 def newpredict_sasrec(model, evaluate, train, valid, test, itemnum, args, mode, usernegs, users):
-    listseqs = list(itemgetter(*users)(train))
-    length = max(map(len, listseqs))
-    seqs = np.array([[0]*(length-len(xi))+xi for xi in listseqs])
-    seqs_valid = np.array(list(itemgetter(*users)(valid)))
-    seqs_test = np.array(list(itemgetter(*users)(test)))
+    seqs = train.window(users)
+    seqs_valid = valid.window(users)
+    seqs_test = test.window(users)
 
     if mode == "test":
         if not args.no_valid_in_test and (not args.sparse or args.override_sparse):
@@ -770,7 +898,7 @@ def newpredict_sasrec(model, evaluate, train, valid, test, itemnum, args, mode,
     for i in range(partitions):
         user_subset = users[subset*i:subset*(i+1)]
         if args.eval_method == 1:
-            negs = np.array(list(itemgetter(*user_subset)(usernegs)))
+            negs = user_negatives(usernegs, user_subset)
         elif args.eval_method == 3:
             negs = (np.arange(1, itemnum+1) + np.zeros((len(user_subset), 1))).astype(int) 
 
@@ -817,12 +945,12 @@ def newpredict_sasrec(model, evaluate, train, valid, test, itemnum, args, mode,
         sys.exit()
     if args.save_ranks:
         np.savetxt('/'.join(args.state_dict_path.split('/')[:-1]) + f"/{args.ranks_name}.txt", fullranks)
-    return fullranks, np.array(list(usernegs.keys()))[cond]
+    return fullranks, np.asarray(users)[cond]
 
 
 def newpredict_bprmf(model, evaluate, train, valid, test, itemnum, args, mode, usernegs, users):
-    seqs_valid = np.array(list(itemgetter(*users)(valid)))
-    seqs_test = np.array(list(itemgetter(*users)(test)))
+    seqs_valid = valid.window(users)
+    seqs_test = test.window(users)
 
     if mode == "test":
         item_idxs = seqs_test
@@ -830,7 +958,7 @@ def newpredict_bprmf(model, evaluate, train, valid, test, itemnum, args, mode, u
         item_idxs = seqs_valid
 
     if args.eval_method == 1:
-        negs = np.array(list(itemgetter(*users)(usernegs)))
+        negs = user_negatives(usernegs, users)
     elif args.eval_method == 3:
         negs = (np.arange(1, itemnum+1) + np.zeros((len(users), 1))).astype(int) 
     item_idxs = np.concatenate((item_idxs, negs), axis=1)
@@ -870,15 +998,13 @@ def newpredict_bprmf(model, evaluate, train, valid, test, itemnum, args, mode, u
                 np.savetxt('/'.join(args.state_dict_path.split('/')[:-1]) + f"/{args.ranks_name}_{alpha}.txt", fullranks[k])
         else:
             np.savetxt('/'.join(args.state_dict_path.split('/')[:-1]) + f"/{args.ranks_name}.txt", fullranks)
-    return fullranks, np.array(list(usernegs.keys()))
+    return fullranks, np.asarray(users)
 
 
 def newpredict_bert4rec(model, evaluate, train, valid, test, itemnum, args, mode, usernegs, users):
-    listseqs = list(itemgetter(*users)(train))
-    length = max(map(len, listseqs))
-    seqs = np.array([[0]*(length-len(xi))+xi for xi in listseqs])
-    seqs_valid = np.array(list(itemgetter(*users)(valid)))
-    seqs_test = np.array(list(itemgetter(*users)(test)))
+    seqs = train.window(users)
+    seqs_valid = valid.window(users)
+    seqs_test = test.window(users)
 
     if mode == "test":
         if not args.no_valid_in_test:
@@ -888,11 +1014,11 @@ def newpredict_bert4rec(model, evaluate, train, valid, test, itemnum, args, mode
         item_idxs = seqs_valid
     seqs = seqs[:, -args.maxlen:]
 
-    negs = np.array(list(itemgetter(*usernegs.keys())(usernegs)))
     cond = np.isin(users, list(usernegs.keys())) # (item_idxs != 0) & ()
     seqs, item_idxs, users = seqs[cond], item_idxs[cond], np.array(users)[cond]
     cond = np.squeeze(item_idxs, 1) != 0
     seqs, item_idxs, users = seqs[cond], item_idxs[cond], np.array(users)[cond]
+    negs = user_negatives(usernegs, users)
     item_idxs = np.concatenate((item_idxs, negs), axis=1)
 
     fullranks = np.zeros(seqs.shape[0])
@@ -904,15 +1030,13 @@ def newpredict_bert4rec(model, evaluate, train, valid, test, itemnum, args, mode
             *[torch.LongTensor(seqs[inds]), torch.LongTensor(item_idxs[inds])]
         )
         fullranks[inds] = predictions.argsort(axis=1).argsort(axis=1)[:, 0].to('cpu')
-    return fullranks, np.array(list(usernegs.keys()))[cond]
+    return fullranks, users
 
 
 def newpredict_cl4srec(model, evaluate, train, valid, test, itemnum, args, mode, usernegs, users):
-    listseqs = list(itemgetter(*users)(train))
-    length = max(map(len, listseqs))
-    seqs = np.array([[0]*(length-len(xi))+xi for xi in listseqs])
-    seqs_valid = np.array(list(itemgetter(*users)(valid)))
-    seqs_test = np.array(list(itemgetter(*users)(test)))
+    seqs = train.window(users)
+    seqs_valid = valid.window(users)
+    seqs_test = test.window(users)
 
     if mode == "test":
         if not args.no_valid_in_test and (not args.sparse or args.override_sparse):
@@ -930,7 +1054,7 @@ def newpredict_cl4srec(model, evaluate, train, valid, test, itemnum, args, mode,
     for i in range(partitions):
         user_subset = users[subset*i:subset*(i+1)]
         if args.eval_method == 1:
-            negs = np.array(list(itemgetter(*user_subset)(usernegs)))
+            negs = user_negatives(usernegs, user_subset)
         elif args.eval_method == 3:
             negs = (np.arange(1, itemnum+1) + np.zeros((len(user_subset), 1))).astype(int)
 
@@ -977,7 +1101,7 @@ def newpredict_cl4srec(model, evaluate, train, valid, test, itemnum, args, mode,
         sys.exit()
     if args.save_ranks:
         np.savetxt('/'.join(args.state_dict_path.split('/')[:-1]) + f"/{args.ranks_name}.txt", fullranks)
-    return fullranks, np.array(list(usernegs.keys()))[cond]
+    return fullranks, np.asarray(users)[cond]
 
 
 # def newpredict_recbole(model, evaluate, train, valid, test, itemnum, args, mode, usernegs, users, userlens):